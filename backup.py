@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+💾 Выгрузка и загрузка данных бота
+python backup.py export [--csv] OUT     # OUT: файл .ndjson, «-» или папка
+python backup.py import IN              # IN: файл .ndjson, «-» или папка
+
+Выгружать можно на ходу: каждый файл БД читается из своего снимка, все
+снимки открываются разом в начале. Память не растёт с размером таблиц.
+Загружать — только при остановленном боте и в пустую БД; по шардам
+строки раскладываются по DB_SHARDS.
+
+NDJSON: перед строками таблицы — {"table": ..., "columns": [...]},
+потом по массиву значений на строку. CSV: по файлу на таблицу с
+заголовком, NULL записывается как \\N.
+"""
+
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import sys
+import time
+from itertools import chain
+
+import main
+
+TABLES = ("known_users", "marriages", "pending", "msg_cnt",
+          "msg_daily", "msg_weekly")
+BATCH = 50_000          # строк на один executemany
+NULL = "\\N"
+
+
+def _files(table: str, paths: list) -> list:
+    return [main.DB_PATH] if table == "known_users" else paths
+
+
+def _has(c: sqlite3.Connection, table: str) -> bool:
+    return c.execute("SELECT 1 FROM sqlite_master WHERE type='table' "
+                     "AND name=?", (table,)).fetchone() is not None
+
+
+# ── выгрузка ──
+
+def snapshot() -> tuple:
+    """Read-only соединения ко всем файлам, в каждом открыт снимок."""
+    if not os.path.exists(main.DB_PATH):
+        raise SystemExit(f"{main.DB_PATH} не найден")
+    conns = {}
+
+    def ro(path):
+        c = sqlite3.connect(f"file:{path}?mode=ro", uri=True,
+                            isolation_level=None)
+        c.execute("BEGIN")
+        # в WAL снимок фиксируется первым чтением, а не BEGIN
+        c.execute("SELECT count(*) FROM sqlite_master").fetchone()
+        return c
+
+    conns[main.DB_PATH] = ro(main.DB_PATH)
+    try:
+        n = main.shard_layout(conns[main.DB_PATH]) or 1
+    except sqlite3.OperationalError:     # до миграции 4 шардов не было
+        n = 1
+    paths = main.shard_paths(n)
+    for p in paths:
+        if p not in conns:
+            conns[p] = ro(p)
+    return conns, paths
+
+
+def dump(conns: dict, paths: list):
+    """(таблица, колонки, строки) — строки ленивым итератором по файлам."""
+    for t in TABLES:
+        files = [p for p in _files(t, paths) if _has(conns[p], t)]
+        if not files:
+            continue
+        cols = [d[0] for d in
+                conns[files[0]].execute(f"SELECT * FROM {t} LIMIT 0")
+                .description]
+        yield t, cols, chain.from_iterable(
+            conns[p].execute(f"SELECT * FROM {t}") for p in files)
+
+
+def write_ndjson(f, tables) -> dict:
+    encode = json.JSONEncoder(ensure_ascii=False).encode
+    counts = {}
+    for t, cols, rows in tables:
+        f.write(json.dumps({"table": t, "columns": cols}) + "\n")
+        n = 0
+        for r in rows:
+            f.write(encode(r) + "\n")
+            n += 1
+        counts[t] = n
+    return counts
+
+
+def write_csv(folder: str, tables) -> dict:
+    os.makedirs(folder, exist_ok=True)
+    counts = {}
+    for t, cols, rows in tables:
+        with open(os.path.join(folder, f"{t}.csv"), "w", newline="",
+                  encoding="utf-8") as f:
+            w = csv.writer(f)
+            w.writerow(cols)
+            n = 0
+            for r in rows:
+                w.writerow([NULL if v is None else v for v in r])
+                n += 1
+        counts[t] = n
+    return counts
+
+
+# ── загрузка ──
+
+def read_ndjson(f):
+    """(таблица, колонки, строка) по одной."""
+    # raw_decode без обёртки json.loads — вдвое быстрее на мелких строках
+    decode = json.JSONDecoder().raw_decode
+    t = cols = None
+    for line in f:
+        if line.startswith("["):
+            yield t, cols, decode(line)[0]
+        elif line.startswith("{"):
+            head = json.loads(line)
+            t, cols = head["table"], head["columns"]
+
+
+def read_csv(folder: str):
+    for t in TABLES:
+        path = os.path.join(folder, f"{t}.csv")
+        if not os.path.exists(path):
+            continue
+        with open(path, newline="", encoding="utf-8") as f:
+            r = csv.reader(f)
+            cols = next(r)
+            for row in r:
+                yield t, cols, [None if v == NULL else v for v in row]
+
+
+class Loader:
+    """Всё в одну транзакцию на файл, индексы — после данных."""
+
+    def __init__(self):
+        # схема, раскладка по DB_SHARDS и диапазоны id — как при запуске
+        main.init_db()
+        main.close_db()
+        main._db_pool.shutdown()
+        self.paths = main.shard_paths(main.DB_SHARDS)
+        self.conns = {p: sqlite3.connect(p, isolation_level=None)
+                      for p in dict.fromkeys([main.DB_PATH, *self.paths])}
+        for p, c in self.conns.items():
+            for t in TABLES:
+                if c.execute(f"SELECT 1 FROM {t} LIMIT 1").fetchone():
+                    raise SystemExit(f"{p}: в {t} уже есть данные, "
+                                     f"загружать можно только в пустую БД")
+        self.indexes = {}
+        for p, c in self.conns.items():
+            c.execute("PRAGMA synchronous=OFF")
+            c.execute(f"PRAGMA cache_size=-{256 * 1024}")
+            c.execute("BEGIN")
+            self.indexes[p] = c.execute(
+                "SELECT name, sql FROM sqlite_master WHERE type='index' "
+                "AND sql IS NOT NULL AND tbl_name IN "
+                f"({','.join('?' * len(TABLES))})", TABLES).fetchall()
+            for name, _ in self.indexes[p]:
+                c.execute(f"DROP INDEX {name}")
+        self.counts = {}
+
+    def load(self, rows):
+        t = sql = None
+        pending = {}    # путь -> строки до executemany
+        for table, cols, row in rows:
+            if table != t:
+                self._flush(sql, pending)
+                if table not in TABLES:
+                    raise SystemExit(f"неизвестная таблица {table}")
+                t = table
+                sql = (f"INSERT INTO {t}({','.join(cols)}) "
+                       f"VALUES({','.join('?' * len(cols))})")
+                files = _files(t, self.paths)
+                cid = cols.index("chat_id") if len(files) > 1 else None
+            path = (files[main.shard_of(int(row[cid]), len(files))]
+                    if cid is not None else files[0])
+            batch = pending.setdefault(path, [])
+            batch.append(row)
+            self.counts[t] = self.counts.get(t, 0) + 1
+            if len(batch) >= BATCH:
+                self.conns[path].executemany(sql, batch)
+                batch.clear()
+        self._flush(sql, pending)
+
+    def _flush(self, sql, pending):
+        for path, batch in pending.items():
+            if batch:
+                self.conns[path].executemany(sql, batch)
+        pending.clear()
+
+    def finish(self):
+        shards = self.paths if len(self.paths) > 1 else []
+        # как reshard: новые id — выше всех загруженных, без пересечений
+        span = main.SHARD_ID_SPAN
+        hi = max(c.execute("SELECT max(seq) FROM sqlite_sequence")
+                 .fetchone()[0] or 0 for c in self.conns.values())
+        base = (hi // span + 1) * span
+        for i, p in enumerate(shards):
+            main.seed_ids(self.conns[p], base + i * span)
+        for p, c in self.conns.items():
+            for _, sql in self.indexes[p]:
+                c.execute(sql)
+            if p in self.paths:
+                main.rebuild_tops(c)
+            c.execute("COMMIT")
+            c.execute("PRAGMA optimize")
+            c.close()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    ex = sub.add_parser("export")
+    ex.add_argument("--csv", action="store_true", help="CSV в папку OUT")
+    ex.add_argument("out")
+    im = sub.add_parser("import")
+    im.add_argument("src")
+    a = ap.parse_args()
+
+    t0 = time.perf_counter()
+    if a.cmd == "export":
+        conns, paths = snapshot()
+        if a.csv:
+            counts = write_csv(a.out, dump(conns, paths))
+        elif a.out == "-":
+            counts = write_ndjson(sys.stdout, dump(conns, paths))
+        else:
+            with open(a.out, "w", encoding="utf-8") as f:
+                counts = write_ndjson(f, dump(conns, paths))
+        for c in conns.values():
+            c.close()
+    else:
+        loader = Loader()
+        if os.path.isdir(a.src):
+            loader.load(read_csv(a.src))
+        elif a.src == "-":
+            loader.load(read_ndjson(sys.stdin))
+        else:
+            with open(a.src, encoding="utf-8") as f:
+                loader.load(read_ndjson(f))
+        loader.finish()
+        counts = loader.counts
+    print(", ".join(f"{t}: {n:,}" for t, n in counts.items())
+          + f" — {time.perf_counter() - t0:.1f} с", file=sys.stderr)
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+⏱ Бенчмарки горячих путей бота, без сети и без Telegram
+python bench.py [-n 50] [--only card,msg,db,marriages]
+                [--rows 10000,100000,1000000] [--json out.json]
+                [--compare old.json]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+from types import SimpleNamespace
+
+from PIL import Image, ImageDraw
+
+import main
+
+logging.getLogger().setLevel(logging.WARNING)
+
+
+def timeit(fn, n):
+    t = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - t) / n * 1000
+
+
+def latency(fn, args, n):
+    """p50/p99 одного вызова в мкс по n вызовам со случайными args."""
+    ts = []
+    for _ in range(n):
+        a = random.choice(args)
+        t = time.perf_counter()
+        fn(*a)
+        ts.append((time.perf_counter() - t) * 1e6)
+    ts.sort()
+    return {"p50_us": ts[len(ts) // 2], "p99_us": ts[int(len(ts) * .99)]}
+
+
+def legacy_heart(draw, cx, cy, size, color=(255, 70, 80)):
+    pts = []
+    for deg in range(360):
+        t = math.radians(deg)
+        x = 16 * math.sin(t) ** 3
+        y = -(13*math.cos(t) - 5*math.cos(2*t) -
+              2*math.cos(3*t) - math.cos(4*t))
+        pts.append((cx + x * size / 17, cy + y * size / 17))
+    draw.polygon(pts, fill=color)
+
+
+def legacy_background():
+    """Фон так, как он рисовался до шаблона: на каждую карточку заново."""
+    W, H = main.CARD_W, main.CARD_H
+    img = Image.new("RGBA", (W, H))
+    d = ImageDraw.Draw(img)
+    for y in range(H):
+        t = y / H
+        d.line([(0, y), (W, y)], fill=(int(210*(1-t) + 75*t),
+                                       int(130*(1-t) + 35*t),
+                                       int(210*(1-t) + 175*t)))
+    for hx, hy, hs in [
+        (60, 55, 9), (840, 45, 7), (80, 430, 8),
+        (820, 410, 6), (450, 15, 6), (750, 240, 5),
+        (150, 250, 5),
+    ]:
+        legacy_heart(d, hx, hy, hs, (255, 220, 230))
+    legacy_heart(d, W // 2, main.AV_Y + main.AV_SZ // 2 + 5, 16)
+    return img
+
+
+# ── БД во временной папке ──
+
+def fresh_db(tmp, name):
+    if main.db:
+        main.close_db()
+        main._db_pool.shutdown()
+    main.DB_PATH = os.path.join(tmp, name)
+    main.wb = main.WriteBehind()
+    main.user_cache = main.UserCache()
+    # кеши процесса помнят прошлую БД: топы, страницы /marriages, file_id
+    for cache in (main._tops, main._mar_pages, main._media):
+        cache.clear()
+    main.init_db()
+
+
+def seed(rows, chats=1000):
+    """rows юзеров/счётчиков, rows/2 браков, rows/10 предложений."""
+    rnd = random.Random(1)
+    with main.db.write() as c:
+        c.executemany(
+            "INSERT INTO known_users VALUES(?,?,?,?)",
+            ((u, f"user{u}", f"User {u}", "") for u in range(rows)))
+    for s in dict.fromkeys(main.shards):
+        def mine(cid):
+            return main.shard(cid) is s
+        with s.write() as c:
+            c.executemany(
+                "INSERT INTO msg_cnt VALUES(?,?,?)",
+                ((u, -(u % chats), rnd.randrange(1000))
+                 for u in range(rows) if mine(-(u % chats))))
+            # пары (2k, 2k+1) в чате -(k % chats)
+            c.executemany(
+                "INSERT INTO marriages(chat_id,user1_id,user1_name,user1_un,"
+                "user2_id,user2_name,user2_un,married_at) "
+                "VALUES(?,?,?,?,?,?,?,datetime('now',?))",
+                ((-(k % chats), 2*k, "A", f"user{2*k}", 2*k+1, "B",
+                  f"user{2*k+1}", f"-{rnd.randrange(1000)} days")
+                 for k in range(rows // 2) if mine(-(k % chats))))
+            c.executemany(
+                "INSERT INTO pending(chat_id,initiator_id,u1_id,u2_id,"
+                "created_at) VALUES(?,?,?,?,datetime('now'))",
+                ((-(k % chats), k, k, k + 1)
+                 for k in range(rows // 10) if mine(-(k % chats))))
+
+
+# ── наборы ──
+
+def bench_card(n):
+    av = Image.new("RGBA", (640, 640), (200, 120, 160, 255))
+    raw = main.io.BytesIO()
+    av.convert("RGB").save(raw, "JPEG")
+    raw = raw.getvalue()
+    circle = main._crop_circle(av, main.AV_SZ)
+    base = main._card_base().copy()
+
+    def cold_base():
+        main._card_base.cache_clear()
+        main._card_base()
+
+    def avatars():
+        img = base.copy()
+        main.paste_avatars(img, circle, None)
+
+    def texts():
+        main.draw_texts(base.copy(), "@alice", "@bob", 123, 4567,
+                        "01.01.2025")
+
+    composed = main.compose_card(circle, None, "@alice", "@bob", 123, 4567,
+                                 "01.01.2025")
+
+    def card():
+        main.build_card(circle, None, "@alice", "@bob", 123, 4567,
+                        "01.01.2025")
+
+    def hearts_legacy():
+        d = ImageDraw.Draw(Image.new("RGBA", (64, 64)))
+        for _ in range(8):
+            legacy_heart(d, 32, 32, 12)
+
+    def hearts_sprite():
+        img = Image.new("RGBA", (64, 64))
+        for _ in range(8):
+            main.stamp(img, "heart", 32, 32, 12)
+
+    res = {
+        "8 сердец: полигон": timeit(hearts_legacy, n),
+        "8 сердец: спрайт": timeit(hearts_sprite, n),
+        "фон по-старому": timeit(legacy_background, n),
+        "шаблон фона с нуля": timeit(cold_base, n),
+        "фон из шаблона (.copy)": timeit(lambda: main._card_base().copy(), n),
+        "кружок из фото": timeit(lambda: main.prepare_avatar(raw), n),
+        "аватарки на фон": timeit(avatars, n),
+        "тексты": timeit(texts, n),
+        "кодирование": timeit(lambda: main.encode_card(composed), n),
+        "build_card целиком": timeit(card, n),
+    }
+    for name, ms in res.items():
+        print(f"{name:<28} {ms:8.2f} мс")
+    return {k: {"ms": v} for k, v in res.items()}
+
+
+def bench_msg(n, tmp):
+    """cache_user + inc_msg со сбросом каждые batch записей."""
+    users = [SimpleNamespace(id=u, username=f"user{u}", first_name="U",
+                             last_name=None, is_bot=False)
+             for u in range(1000)]
+    total = max(n, 1) * 1000
+    res = {}
+    for batch in (50, 500, 5000):
+        fresh_db(tmp, f"msg{batch}.db")
+        t = time.perf_counter()
+        for i in range(total):
+            u = users[i % len(users)]
+            main.cache_user(u)
+            main.inc_msg(u.id, -(i % 50))
+            if len(main.wb) >= batch:
+                main.wb.flush()
+        main.wb.flush()
+        rate = total / (time.perf_counter() - t)
+        res[f"batch={batch}"] = {"msgs_per_s": rate}
+        print(f"on_message, сброс по {batch:<5} {rate:12,.0f} сообщ/с")
+    return res
+
+
+def bench_db(n, tmp, sizes):
+    res = {}
+    for rows in sizes:
+        fresh_db(tmp, f"db{rows}.db")
+        t = time.perf_counter()
+        seed(rows)
+        print(f"— {rows:,} строк (засев {time.perf_counter() - t:.1f} с)")
+        chats = 1000
+        calls = {
+            "get_marriage": (main.get_marriage,
+                             [(u, -((u // 2) % chats))
+                              for u in random.sample(range(rows), 1000)]),
+            "pending_for": (main.pending_for,
+                            [(u, -(u % chats))
+                             for u in random.sample(range(rows), 1000)]),
+            "msg_cnt": (main.msg_cnt,
+                        [(u, -(u % chats))
+                         for u in random.sample(range(rows), 1000)]),
+        }
+
+        def find_cold(un):
+            # мимо LRU, чтобы мерить именно запрос к БД
+            main.user_cache = main.UserCache()
+            return main.find_user(un)
+        calls["find_user"] = (find_cold,
+                              [(f"user{u}",)
+                               for u in random.sample(range(rows), 1000)])
+        for name, (fn, args) in calls.items():
+            r = latency(fn, args, max(n, 1) * 20)
+            res[f"{name} rows={rows}"] = r
+            print(f"  {name:<14} p50 {r['p50_us']:8.1f} мкс   "
+                  f"p99 {r['p99_us']:8.1f} мкс")
+    return res
+
+
+def bench_marriages(n, tmp):
+    """Страница /marriages в чате с большим числом пар."""
+    res = {}
+    for couples in (100, 10_000):
+        fresh_db(tmp, f"mar{couples}.db")
+        seed(couples * 2, chats=1)
+
+        async def run():
+            out = {}
+            t = time.perf_counter()
+            for _ in range(n):
+                main.forget_marriages(0)
+                await main.marriages_view(0)
+            out["cold_ms"] = (time.perf_counter() - t) / n * 1000
+            t = time.perf_counter()
+            for _ in range(n):
+                await main.marriages_view(0)
+            out["cached_ms"] = (time.perf_counter() - t) / n * 1000
+            text, kb = await main.marriages_view(0)
+            cur = kb.inline_keyboard[0][-1].callback_data.split("_", 4)
+            t = time.perf_counter()
+            for _ in range(n):
+                main.forget_marriages(0)
+                await main.marriages_view(0, (cur[4], int(cur[3])), False,
+                                          int(cur[2]))
+            out["next_page_ms"] = (time.perf_counter() - t) / n * 1000
+            return out
+        r = asyncio.run(run())
+        res[f"couples={couples}"] = r
+        print(f"/marriages, {couples:>6} пар: с запросом "
+              f"{r['cold_ms']:.2f} мс, из кеша {r['cached_ms']:.3f} мс, "
+              f"след. страница {r['next_page_ms']:.2f} мс")
+    return res
+
+
+def meta():
+    try:
+        rev = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+            text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except OSError:
+        rev = ""
+    return {"commit": rev, "python": platform.python_version(),
+            "machine": platform.machine(), "time": time.time()}
+
+
+def compare(old, new):
+    """Поменявшиеся больше чем на 10% метрики; время меньше — лучше."""
+    for suite, metrics in new["results"].items():
+        for name, vals in metrics.items():
+            for k, v in vals.items():
+                was = old["results"].get(suite, {}).get(name, {}).get(k)
+                if not was:
+                    continue
+                d = (v - was) / was * 100
+                if abs(d) >= 10:
+                    worse = d < 0 if k.endswith("_per_s") else d > 0
+                    print(f"{'🔴' if worse else '🟢'} {suite}/{name}/{k}: "
+                          f"{was:.2f} → {v:.2f} ({d:+.0f}%)")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-n", type=int, default=50, help="повторов на замер")
+    ap.add_argument("--only", default="card,msg,db,marriages")
+    ap.add_argument("--rows", default="10000,100000",
+                    help="размеры БД для набора db, через запятую")
+    ap.add_argument("--json", help="записать результаты в файл")
+    ap.add_argument("--compare", help="сравнить с прошлым --json")
+    a = ap.parse_args()
+    only = a.only.split(",")
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        if "card" in only:
+            results["card"] = bench_card(a.n)
+        if "msg" in only:
+            results["msg"] = bench_msg(a.n, tmp)
+        if "db" in only:
+            results["db"] = bench_db(
+                a.n, tmp, [int(x) for x in a.rows.split(",")])
+        if "marriages" in only:
+            results["marriages"] = bench_marriages(a.n, tmp)
+        if main.db:
+            main.close_db()
+    out = {"meta": meta(), "results": results}
+    if a.json:
+        with open(a.json, "w") as f:
+            json.dump(out, f, ensure_ascii=False, indent=1)
+    if a.compare:
+        with open(a.compare) as f:
+            compare(json.load(f), out)
@@ -0,0 +1,504 @@
+#!/usr/bin/env python3
+"""
+🏋 Нагрузочный прогон: настоящий build_app() против фейкового Bot API
+python loadtest.py [--chats 2000] [--members 30] [--updates 20000]
+                   [--rate 1000] [--replay stream.ndjson] [--save FILE]
+                   [--json out.json]
+
+Фейковый сервер (отдельный процесс) отдаёт апдейты через getUpdates,
+отвечает на send*/edit*/answerCallbackQuery, getUserProfilePhotos,
+getFile и скачивание файла, а на кнопки «Согласен»/«Развестись» в
+ответах бота сам присылает нажатия.
+"""
+
+import argparse
+import asyncio
+import heapq
+import io
+import json
+import logging
+import multiprocessing
+import os
+import random
+import tempfile
+import threading
+import time
+import urllib.request
+from collections import Counter, defaultdict, deque
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from PIL import Image
+from telegram import Update
+from telegram.ext import TypeHandler
+
+import main
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Wedding",
+            "username": "wedding_load_bot", "can_join_groups": True,
+            "can_read_all_group_messages": True,
+            "supports_inline_queries": False}
+GETUPDATES_LIMIT = 100
+
+
+# ══════════════════════════════════════════════════════════
+#  ПОТОК АПДЕЙТОВ
+# ══════════════════════════════════════════════════════════
+
+def _user(uid):
+    return {"id": uid, "is_bot": False, "first_name": f"U{uid}",
+            "username": f"u{uid}"}
+
+
+def _chat(cid):
+    return {"id": cid, "type": "supergroup", "title": f"g{-cid}"}
+
+
+def synthetic(a):
+    """Сообщения в a.chats группах; чаты погорячее выбираются чаще."""
+    rnd = random.Random(a.seed)
+    cum, s = [], 0.0
+    for i in range(a.chats):
+        s += 1 / (i + 1) ** 0.8
+        cum.append(s)
+    kinds = ["msg", "/marry", "/couple", "/marriages", "/divorce", "/top"]
+    mix = [a.mix_msg, a.mix_marry, a.mix_couple, a.mix_marriages,
+           a.mix_divorce, a.mix_top]
+    msg_ids = Counter()
+    pairs = defaultdict(list)    # cid -> кто кому делал предложение
+    for _ in range(a.updates):
+        ci = rnd.choices(range(a.chats), cum_weights=cum)[0]
+        cid = -1_000_000_000 - ci
+        base = ci * a.members + 1000
+        uid = base + rnd.randrange(a.members)
+        kind = rnd.choices(kinds, mix)[0]
+        if kind == "msg":
+            text, ent = "привет 👋", None
+        elif kind == "/marry":
+            other = base + rnd.randrange(a.members)
+            pairs[cid].append((uid, other))
+            text, ent = f"/marry @u{other}", 6
+        else:
+            # /couple и /divorce — чаще от тех, кто уже мог пожениться
+            if kind in ("/couple", "/divorce") and pairs[cid]:
+                uid = rnd.choice(rnd.choice(pairs[cid]))
+            text, ent = kind, len(kind)
+        msg_ids[cid] += 1
+        m = {"message_id": msg_ids[cid], "date": int(time.time()),
+             "chat": _chat(cid), "from": _user(uid), "text": text}
+        if ent:
+            m["entities"] = [{"type": "bot_command", "offset": 0,
+                              "length": ent}]
+        yield {"message": m}
+
+
+def replay(path):
+    """Записанный поток: по апдейту JSON на строку, update_id не важен."""
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                u = json.loads(line)
+                u.pop("update_id", None)
+                yield u
+
+
+def saving(stream, path):
+    with open(path, "w") as f:
+        for u in stream:
+            f.write(json.dumps(u, ensure_ascii=False) + "\n")
+            yield u
+
+
+# ══════════════════════════════════════════════════════════
+#  ФЕЙКОВЫЙ BOT API
+# ══════════════════════════════════════════════════════════
+
+class FakeApi:
+    def __init__(self, a, stream):
+        self.a = a
+        self.rnd = random.Random(a.seed + 1)
+        self.cond = threading.Condition()
+        self.ready = deque()      # ждут getUpdates
+        self.later = []           # heap (когда, n, апдейт) — нажатия кнопок
+        self.next_id = 1
+        self.bot_msg = 10 ** 6
+        self.calls = Counter()
+        self.generated = self.delivered = 0
+        self.exhausted = False
+        self.stream = stream
+        buf = io.BytesIO()
+        Image.new("RGB", (320, 320), (90, 140, 200)).save(buf, "JPEG")
+        self.jpeg = buf.getvalue()
+
+    # ── производитель ──
+
+    def _push(self, u):
+        u["update_id"] = self.next_id
+        u["_t"] = time.time()
+        self.next_id += 1
+        self.generated += 1
+        self.ready.append(u)
+        self.cond.notify_all()
+
+    def produce(self):
+        step = 1 / self.a.rate if self.a.rate else 0
+        t = time.monotonic()
+        for u in self.stream:
+            if step:
+                t += step
+                time.sleep(max(0.0, t - time.monotonic()))
+            with self.cond:
+                # без темпа — не уходим дальше чем на пару пачек вперёд
+                while not step and len(self.ready) > 10 * GETUPDATES_LIMIT:
+                    self.cond.wait(0.1)
+                self._due()
+                self._push(u)
+        with self.cond:
+            self.exhausted = True
+        while True:
+            with self.cond:
+                self._due()
+            time.sleep(0.05)
+
+    def _due(self):
+        now = time.monotonic()
+        while self.later and self.later[0][0] <= now:
+            self._push(heapq.heappop(self.later)[2])
+
+    # ── нажатия на кнопки в ответах бота ──
+
+    def _click(self, cid, mid, data, uid):
+        u = {"callback_query": {
+            "id": str(self.rnd.getrandbits(48)), "from": _user(uid),
+            "chat_instance": str(cid), "data": data,
+            "message": {"message_id": mid, "date": int(time.time()),
+                        "chat": _chat(cid), "from": BOT_USER, "text": "…"},
+        }}
+        when = time.monotonic() + self.rnd.uniform(0.2, 2.0)
+        heapq.heappush(self.later, (when, self.rnd.random(), u))
+
+    def _buttons(self, cid, mid, markup):
+        by_user = defaultdict(dict)
+        for row in json.loads(markup).get("inline_keyboard", []):
+            for b in row:
+                d = b.get("callback_data", "")
+                kind = d.split("_", 1)[0]
+                if kind in ("yes", "no", "dyes", "dno"):
+                    by_user[int(d.rsplit("_", 1)[1])][kind] = d
+        for uid, btn in by_user.items():
+            if "yes" in btn:
+                ok = self.rnd.random() < self.a.accept
+                self._click(cid, mid, btn["yes" if ok else "no"], uid)
+            elif "dyes" in btn:
+                ok = self.rnd.random() < self.a.divorce
+                self._click(cid, mid, btn["dyes" if ok else "dno"], uid)
+
+    # ── методы ──
+
+    def _message(self, cid, **extra):
+        self.bot_msg += 1
+        return {"message_id": self.bot_msg, "date": int(time.time()),
+                "chat": _chat(cid), "from": BOT_USER, **extra}
+
+    def call(self, method, p):
+        self.calls[method] += 1
+        cid = int(p["chat_id"]) if "chat_id" in p else 0
+        if method == "getMe":
+            return BOT_USER
+        if method == "getUpdates":
+            return self.get_updates(float(p.get("timeout", 0)))
+        if method == "sendMessage":
+            m = self._message(cid, text=p.get("text", ""))
+            if "reply_markup" in p:
+                with self.cond:
+                    self._buttons(cid, m["message_id"], p["reply_markup"])
+            return m
+        if method == "sendPhoto":
+            n = self.bot_msg
+            return self._message(cid, caption=p.get("caption", ""), photo=[
+                {"file_id": f"card{n}", "file_unique_id": f"c{n}",
+                 "width": main.CARD_W, "height": main.CARD_H}])
+        if method == "editMessageText":
+            if "reply_markup" in p:
+                with self.cond:
+                    self._buttons(cid, int(p["message_id"]),
+                                  p["reply_markup"])
+            return self._message(cid, text=p.get("text", ""))
+        if method == "getUserProfilePhotos":
+            uid = p["user_id"]
+            return {"total_count": 1, "photos": [[
+                {"file_id": f"ph{uid}", "file_unique_id": f"ph{uid}",
+                 "width": 320, "height": 320}]]}
+        if method == "getFile":
+            return {"file_id": p["file_id"], "file_unique_id": p["file_id"],
+                    "file_size": len(self.jpeg),
+                    "file_path": f"photos/{p['file_id']}.jpg"}
+        return True    # answerCallbackQuery, deleteMessage, setWebhook…
+
+    def get_updates(self, timeout):
+        with self.cond:
+            if not self.ready:
+                self.cond.wait(min(timeout, 5))
+            out = [self.ready.popleft()
+                   for _ in range(min(len(self.ready), GETUPDATES_LIMIT))]
+            self.delivered += len(out)
+            self.cond.notify_all()
+        return out
+
+    def stats(self):
+        with self.cond:
+            return {"generated": self.generated, "delivered": self.delivered,
+                    "done": (self.exhausted and not self.ready
+                             and not self.later),
+                    "calls": dict(self.calls)}
+
+
+def _params(headers, body) -> dict:
+    ctype = headers.get("content-type", "")
+    if ctype.startswith("multipart/"):
+        msg = BytesParser().parsebytes(
+            b"content-type: " + ctype.encode() + b"\r\n\r\n" + body)
+        return {part.get_param("name", header="content-disposition"):
+                part.get_payload(decode=True).decode(errors="replace")
+                for part in msg.get_payload()
+                if not part.get_filename()}
+    return {k: v[0] for k, v in parse_qs(body.decode()).items()}
+
+
+def serve(port, a):
+    logging.getLogger().setLevel(logging.WARNING)
+    stream = replay(a.replay) if a.replay else synthetic(a)
+    if a.save:
+        stream = saving(stream, a.save)
+    api = FakeApi(a, stream)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # иначе заголовки и тело уходят двумя пакетами и ловят
+        # 40 мс delayed ACK на каждом вызове API
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, body: bytes, ctype="application/json"):
+            self.send_response(200)
+            self.send_header("content-type", ctype)
+            self.send_header("content-length", str(len(body)))
+            self.end_headers()
+            try:
+                self.wfile.write(body)
+            except ConnectionError:
+                pass    # бот уже закрыл long poll
+
+        def do_POST(self):
+            n = int(self.headers.get("content-length") or 0)
+            body = self.rfile.read(n)
+            if self.path == "/_stats":
+                return self._send(json.dumps(api.stats()).encode())
+            if self.path.startswith("/file/"):
+                api.calls["download"] += 1
+                return self._send(api.jpeg, "image/jpeg")
+            method = self.path.rsplit("/", 1)[-1]
+            res = api.call(method, _params(self.headers, body))
+            self._send(json.dumps({"ok": True, "result": res}).encode())
+
+        do_GET = do_POST
+
+    srv = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    srv.daemon_threads = True
+    threading.Thread(target=api.produce, daemon=True).start()
+    srv.serve_forever()
+
+
+# ══════════════════════════════════════════════════════════
+#  ЗАМЕРЫ
+# ══════════════════════════════════════════════════════════
+
+def kind(u: Update) -> str:
+    if u.callback_query:
+        return "кнопка " + (u.callback_query.data or "").split("_", 1)[0]
+    m = u.effective_message
+    if m and m.text and m.text.startswith("/"):
+        return m.text.split()[0]
+    return "сообщение"
+
+
+class Meter:
+    """Время от начала обработки апдейта до конца всех групп хендлеров
+    и от появления апдейта на фейковом сервере (поле _t) до того же."""
+
+    def __init__(self):
+        self.t0 = {}
+        self.handler = defaultdict(list)
+        self.e2e = defaultdict(list)
+        self.done = 0
+
+    async def start(self, update, ctx):
+        self.t0[update.update_id] = time.perf_counter()
+
+    async def end(self, update, ctx):
+        t0 = self.t0.pop(update.update_id, None)
+        k = kind(update)
+        if t0 is not None:
+            self.handler[k].append(time.perf_counter() - t0)
+        t = update.api_kwargs.get("_t")
+        if t:
+            self.e2e[k].append(time.time() - t)
+        self.done += 1
+
+
+def pct(xs, p):
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(len(xs) * p))] * 1000 if xs else 0.0
+
+
+def db_size(workdir):
+    return sum(os.path.getsize(os.path.join(workdir, f))
+               for f in os.listdir(workdir) if ".db" in f)
+
+
+def stats(port):
+    req = urllib.request.Request(f"http://127.0.0.1:{port}/_stats",
+                                 method="POST")
+    with urllib.request.urlopen(req) as r:
+        return json.loads(r.read())
+
+
+async def run(a, workdir):
+    srv = multiprocessing.get_context("spawn").Process(
+        target=serve, args=(a.port, a), daemon=True)
+    srv.start()
+    loop = asyncio.get_running_loop()
+    for _ in range(100):
+        try:
+            await loop.run_in_executor(None, stats, a.port)
+            break
+        except OSError:
+            await asyncio.sleep(0.1)
+
+    main.DB_PATH = os.path.join(workdir, "weddings.db")
+    main.AVATAR_DIR = os.path.join(workdir, "avatars")
+    main.BOT_API_URL = f"http://127.0.0.1:{a.port}"
+    if a.no_flood_limits:
+        main.OUT_RATE = main.OUT_CHAT_RATE = main.OUT_CHAT_BURST = 1e9
+        main.outbox = main.Outbox()
+    main.init_db()
+    size0 = db_size(workdir)
+
+    meter = Meter()
+    app = main.build_app("123456:LOADTEST")
+    app.add_handler(TypeHandler(Update, meter.start), group=-100)
+    app.add_handler(TypeHandler(Update, meter.end), group=100)
+    await app.initialize()
+    await main.post_init(app)
+    await app.updater.start_polling(poll_interval=0, timeout=5)
+    await app.start()
+
+    t = time.perf_counter()
+    last = 0
+    while time.perf_counter() - t < a.timeout:
+        await asyncio.sleep(1)
+        s = await loop.run_in_executor(None, stats, a.port)
+        print(f"  {time.perf_counter() - t:6.1f} с: выдано "
+              f"{s['delivered']}, обработано {meter.done} "
+              f"(+{meter.done - last}/с)")
+        last = meter.done
+        if s["done"] and meter.done >= s["delivered"]:
+            break
+    elapsed = time.perf_counter() - t
+
+    await app.updater.stop()
+    await app.stop()
+    await main.post_stop(app)
+    await app.shutdown()
+    await main.post_shutdown(app)
+    s = await loop.run_in_executor(None, stats, a.port)
+    srv.terminate()
+
+    size1 = db_size(workdir)
+    res = {
+        "updates": meter.done,
+        "seconds": elapsed,
+        "updates_per_s": meter.done / elapsed,
+        "db_bytes_before": size0,
+        "db_bytes_after": size1,
+        "db_bytes_per_1k_updates": (size1 - size0) / max(meter.done, 1)
+                                   * 1000,
+        "api_calls": s["calls"],
+        "by_kind": {
+            k: {"n": len(v),
+                "handler_p50_ms": pct(v, .5), "handler_p99_ms": pct(v, .99),
+                "e2e_p50_ms": pct(meter.e2e[k], .5),
+                "e2e_p99_ms": pct(meter.e2e[k], .99)}
+            for k, v in sorted(meter.handler.items())},
+    }
+    every = [x for v in meter.handler.values() for x in v]
+    every_e2e = [x for v in meter.e2e.values() for x in v]
+    res["handler_p50_ms"], res["handler_p99_ms"] = (pct(every, .5),
+                                                    pct(every, .99))
+    res["e2e_p50_ms"], res["e2e_p99_ms"] = (pct(every_e2e, .5),
+                                            pct(every_e2e, .99))
+    return res
+
+
+def report(r):
+    print(f"\n{r['updates']} апдейтов за {r['seconds']:.1f} с — "
+          f"{r['updates_per_s']:.0f} апд/с")
+    print(f"хендлеры: p50 {r['handler_p50_ms']:.2f} мс, "
+          f"p99 {r['handler_p99_ms']:.2f} мс; "
+          f"от сервера: p50 {r['e2e_p50_ms']:.1f} мс, "
+          f"p99 {r['e2e_p99_ms']:.1f} мс")
+    print(f"{'':<16}{'n':>8}{'p50':>10}{'p99':>10}{'e2e p50':>10}"
+          f"{'e2e p99':>10}  (мс)")
+    for k, v in r["by_kind"].items():
+        print(f"{k:<16}{v['n']:>8}{v['handler_p50_ms']:>10.2f}"
+              f"{v['handler_p99_ms']:>10.2f}{v['e2e_p50_ms']:>10.1f}"
+              f"{v['e2e_p99_ms']:>10.1f}")
+    print(f"БД: {r['db_bytes_before'] / 1024:.0f} → "
+          f"{r['db_bytes_after'] / 1024:.0f} КБ "
+          f"({r['db_bytes_per_1k_updates'] / 1024:.1f} КБ на 1000 апдейтов)")
+    print("вызовы API:", ", ".join(f"{k} {v}" for k, v in
+                                    sorted(r["api_calls"].items())))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--chats", type=int, default=2000)
+    ap.add_argument("--members", type=int, default=30,
+                    help="участников в группе")
+    ap.add_argument("--updates", type=int, default=20000)
+    ap.add_argument("--rate", type=float, default=1000,
+                    help="апдейтов в секунду, 0 — как успеет бот")
+    ap.add_argument("--mix-msg", type=float, default=0.93)
+    ap.add_argument("--mix-marry", type=float, default=0.03)
+    ap.add_argument("--mix-couple", type=float, default=0.02)
+    ap.add_argument("--mix-marriages", type=float, default=0.01)
+    ap.add_argument("--mix-divorce", type=float, default=0.01)
+    ap.add_argument("--mix-top", type=float, default=0.01)
+    ap.add_argument("--accept", type=float, default=0.8,
+                    help="доля нажатий «Согласен» на предложение")
+    ap.add_argument("--divorce", type=float, default=0.7,
+                    help="доля подтверждённых разводов")
+    ap.add_argument("--replay", help="NDJSON с записанными апдейтами")
+    ap.add_argument("--save", help="записать поток апдейтов для --replay")
+    ap.add_argument("--no-flood-limits", action="store_true",
+                    help="без лимитов Telegram на исходящие: мерить сам бот")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--port", type=int, default=18181)
+    ap.add_argument("--timeout", type=float, default=600)
+    ap.add_argument("--workdir", help="куда класть БД (по умолчанию — "
+                                      "временная папка)")
+    ap.add_argument("--json", help="записать результаты в файл")
+    a = ap.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = a.workdir or tmp
+        os.makedirs(workdir, exist_ok=True)
+        r = asyncio.run(run(a, workdir))
+    report(r)
+    if a.json:
+        with open(a.json, "w") as f:
+            json.dump(r, f, ensure_ascii=False, indent=1)
@@ -4,28 +4,52 @@
 pip install python-telegram-bot Pillow
 """
 
+import asyncio
+import importlib
+import json
 import logging
+import queue
 import sqlite3
+import threading
 import os
 import io
+import secrets
+import signal
+import socket
+import sys
 import math
+import multiprocessing
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from datetime import datetime
+from bisect import bisect_left
+from functools import lru_cache, partial, wraps
 from typing import Optional
+from urllib.parse import urlparse
 
 from telegram import (
+    Bot,
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
 )
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import (
     Application,
+    BaseUpdateProcessor,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
     filters,
     ContextTypes,
+    Updater,
 )
-from PIL import Image, ImageDraw, ImageFont
+
+_t_imports = time.perf_counter()   # первая отметка этапов запуска
 
 # ══════════════════════════════════════════════════════════
 #  КОНФИГУРАЦИЯ
@@ -42,94 +66,1118 @@ START_IMAGE = "start.png"
 #  gentle bokeh lights, romantic atmosphere,
 #  flat design style, clean and minimal, no text, 16:9"
 
+# write-behind: счётчики сообщений и профили юзеров копятся в памяти
+# и сбрасываются в БД одной транзакцией
+FLUSH_INTERVAL = 2.0   # сек между сбросами
+FLUSH_MAX = 500        # сбросить раньше, если накопилось столько записей
+USER_CACHE_SIZE = 100_000   # профилей known_users в памяти (LRU)
+
+# предложения живут сутки, потом их удаляет фоновый sweeper
+PENDING_TTL = "-1 day"       # модификатор для datetime('now', ...)
+SWEEP_INTERVAL = 60          # сек между проходами
+SWEEP_BATCH = 500            # строк за одну транзакцию
+
+MARRIAGES_PAGE = 20          # пар на страницу /marriages
+
+# активность по суткам и неделям для /top; сутки считаются по времени
+# UTC + DAY_OFFSET сек (по умолчанию московское), недели — с понедельника
+DAY_OFFSET = int(os.environ.get("DAY_OFFSET", "10800"))
+ROLLUP_DAYS = 35             # сколько суток хранить
+ROLLUP_WEEKS = 26            # сколько недель хранить
+TOP_SIZE = 10                # мест в каждом топе /top
+
+# соединения с БД: один постоянный писатель + пул читателей (WAL)
+DB_READERS = 4
+DB_CACHE_KB = 16384              # page cache на соединение
+DB_MMAP_BYTES = 256 * 1024 ** 2
+DB_STMT_CACHE = 256              # подготовленных запросов на соединение
+# marriages, pending, msg_cnt и активность раскладываются по chat_id
+# на DB_SHARDS файлов со своим писателем; known_users и media_cache —
+# всегда в DB_PATH.
+# 1 — всё в одном файле. Менять только через: python reshard.py N
+DB_SHARDS = int(os.environ.get("DB_SHARDS", "1"))
+
+# карточки /couple рисуются в отдельном пуле, чтобы Pillow не стопорил бота
+RENDER_MODE = os.environ.get("RENDER_MODE", "process")   # process | thread
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", "2"))
+RENDER_QUEUE = int(os.environ.get("RENDER_QUEUE", "8"))  # max в работе
+RENDER_TIMEOUT = float(os.environ.get("RENDER_TIMEOUT", "15"))
+# Pillow, шрифты и фон карточки грузятся при первой /couple; 1 — сразу
+# после запуска, в пуле рендера, пока бот уже принимает апдейты
+RENDER_PRELOAD = os.environ.get("RENDER_PRELOAD", "0") == "1"
+
+# кодирование карточки: png | jpeg | webp и бюджет на размер файла
+CARD_FORMAT = os.environ.get("CARD_FORMAT", "png").lower()
+CARD_PNG_LEVEL = int(os.environ.get("CARD_PNG_LEVEL", "3"))      # zlib 0..9
+CARD_QUALITY = int(os.environ.get("CARD_QUALITY", "88"))         # jpeg/webp
+CARD_MIN_QUALITY = 40        # ниже не опускаемся ради бюджета
+CARD_JPEG_SUBSAMPLING = os.environ.get("CARD_JPEG_SUBSAMPLING", "4:2:0")
+CARD_WEBP_METHOD = int(os.environ.get("CARD_WEBP_METHOD", "4"))  # 0..6
+CARD_MAX_BYTES = int(os.environ.get("CARD_MAX_BYTES", "0"))      # 0 — любой
+
+# аватарки: готовые кружки в памяти и на диске по file_unique_id
+AVATAR_DIR = "avatars"
+AVATAR_CACHE_SIZE = 512      # кружков в памяти
+AVATAR_TTL = 3600            # сек, потом заново спросить фото профиля
+AVATAR_DISK_MAX = 5000       # файлов в AVATAR_DIR, давно не нужные — вон
+
+# исходящие: общий лимит бота и лимит на чат (Telegram: ~30/с и ~20/мин)
+OUT_RATE = 30                # сообщений в секунду на бота
+OUT_CHAT_RATE = 20 / 60      # сообщений в секунду на чат
+OUT_CHAT_BURST = 5           # столько можно сразу, потом по лимиту
+OUT_RETRIES = 5              # попыток при 429
+OUT_DRAIN_TIMEOUT = 10       # сколько ждать хвост очереди при остановке
+
+# приём апдейтов: polling | webhook
+UPDATES_MODE = os.environ.get("UPDATES_MODE", "polling")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")   # https://host/путь
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT",
+                                  os.environ.get("PORT", "8443")))
+# если не задан — свой на каждый запуск, setWebhook всё равно повторяется
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+# принятых, но не обработанных апдейтов: столько ждут в очереди и ещё
+# столько — в задачах; дальше приём (getUpdates / ответ webhook) ждёт
+UPDATE_QUEUE_SIZE = int(os.environ.get("UPDATE_QUEUE_SIZE", "10000"))
+# апдейтов в работе одновременно; внутри одного чата — всегда по очереди
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", "64"))
+# апдейтов одного чата в работе и в ожидании своей очереди; сверх —
+# отбрасываются: ответы в чат идут не чаще 20 в минуту, такой хвост он
+# уже не разгребёт, а память под него растёт
+CHAT_UPDATES = int(os.environ.get("CHAT_UPDATES", "1000"))
+# WORKERS=K>0: отдельный процесс принимает апдейты и раздаёт их K
+# процессам-обработчикам по chat_id; 0 — всё в одном процессе
+WORKERS = int(os.environ.get("WORKERS", "0"))
+WORKER_PING = 5              # сек между проверками воркеров
+WORKER_PING_TIMEOUT = 30     # нет pong столько — перезапуск воркера
+WORKER_DRAIN_TIMEOUT = 60    # сек на доработку при остановке
+# Prometheus-метрики по HTTP; 0 — выключено. В режиме WORKERS воркер i
+# слушает METRICS_PORT + i
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "127.0.0.1")
+# сторож event loop: если loop не отвечает дольше STALL_MS — стек и апдейт
+# в лог; 0 — выключено
+STALL_MS = int(os.environ.get("STALL_MS", "250"))
+STALL_TICK = 0.05            # сек между отметками из loop
+# kill -USR1 <pid>: PROFILE_SECONDS снимать стеки и записать профиль
+PROFILE_SECONDS = float(os.environ.get("PROFILE_SECONDS", "30"))
+PROFILE_HZ = 100             # снимков в секунду
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+# свой Bot API сервер (или фейковый для тестов), иначе api.telegram.org
+BOT_API_URL = os.environ.get("BOT_API_URL", "").rstrip("/")
+
 logging.basicConfig(
     format="%(asctime)s [%(levelname)s] %(message)s", level=logging.INFO
 )
 log = logging.getLogger(__name__)
 
+# ══════════════════════════════════════════════════════════
+#  МЕТРИКИ
+# ══════════════════════════════════════════════════════════
+# Свои гистограммы и счётчики в текстовом формате Prometheus, без
+# prometheus_client. Наблюдения идут и из event loop, и из потоков БД —
+# у каждой метрики свой lock.
+
+_registry = []
+_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5,
+            1, 2.5, 5, 10)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name, self.help, self.labels = name, help, labels
+        self._lock = threading.Lock()
+        self._series = {}
+        _registry.append(self)
+
+    def _lbl(self, values: tuple, extra: str = "") -> str:
+        pairs = [f'{k}="{v}"' for k, v in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        with self._lock:
+            series = [(k, list(v) if isinstance(v, list) else v)
+                      for k, v in self._series.items()]
+        for lv, v in series:
+            yield from self._lines(lv, v)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *lv, n: int = 1):
+        with self._lock:
+            self._series[lv] = self._series.get(lv, 0) + n
+
+    def _lines(self, lv, v):
+        yield f"{self.name}{self._lbl(lv)} {v}"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, v: float, *lv):
+        with self._lock:
+            s = self._series.get(lv)
+            if s is None:
+                # по счётчику на корзину, +Inf и сумма
+                s = self._series[lv] = [0] * (len(self.buckets) + 1) + [0.0]
+            s[bisect_left(self.buckets, v)] += 1
+            s[-1] += v
+
+    @contextmanager
+    def timer(self, *lv):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t, *lv)
+
+    def _lines(self, lv, s):
+        acc = 0
+        for b, n in zip((*self.buckets, "+Inf"), s):
+            acc += n
+            le = f'le="{b}"'
+            yield f"{self.name}_bucket{self._lbl(lv, le)} {acc}"
+        yield f"{self.name}_sum{self._lbl(lv)} {s[-1]}"
+        yield f"{self.name}_count{self._lbl(lv)} {acc}"
+
+
+class Gauge(_Metric):
+    """Значение считается в момент запроса: fn() -> число."""
+    kind = "gauge"
+
+    def __init__(self, name, help, fn):
+        super().__init__(name, help)
+        self._series = {(): 0}
+        self.fn = fn
+
+    def _lines(self, lv, v):
+        yield f"{self.name} {self.fn()}"
+
+
+HANDLER_SECONDS = Histogram(
+    "bot_handler_seconds", "Время хендлера", ("handler",))
+HANDLER_ERRORS = Counter(
+    "bot_handler_errors_total", "Исключения в хендлерах", ("handler",))
+UPDATES = Counter("bot_updates_total", "Обработано апдейтов")
+UPDATES_DROPPED = Counter(
+    "bot_updates_dropped_total", "Отброшено апдейтов сверх CHAT_UPDATES")
+UPDATE_WAIT = Histogram(
+    "bot_update_wait_seconds",
+    "Ожидание своей очереди чата и свободного слота до начала обработки")
+DB_SECONDS = Histogram(
+    "bot_db_seconds", "Время хелпера БД в потоке", ("query",))
+DB_WAIT = Histogram(
+    "bot_db_wait_seconds", "Ожидание свободного потока БД")
+AVATAR_SECONDS = Histogram(
+    "bot_avatar_seconds", "Аватарки: скачивание, кружок, чтение с диска",
+    ("stage",))
+CARD_SECONDS = Histogram(
+    "bot_card_stage_seconds", "Этапы отрисовки карточки /couple",
+    ("stage",))
+CARD_FAILED = Counter(
+    "bot_card_failed_total", "Карточка не нарисована", ("reason",))
+AVATAR_FAILED = Counter(
+    "bot_avatar_failed_total", "Кружок аватарки не подготовлен",
+    ("reason",))
+CACHE = Counter(
+    "bot_cache_total", "Обращения к кешам", ("cache", "result"))
+OUT_429 = Counter("bot_outbound_429_total", "Ответы 429 от Telegram")
+Gauge("bot_card_renders", "Карточек в работе и в очереди пула",
+      lambda: _renders)
+Gauge("bot_write_behind", "Записей в буфере write-behind", lambda: len(wb))
+Gauge("bot_outbox_chats", "Чатов с неотправленными сообщениями",
+      lambda: len(outbox._workers))
+
+
+def timed(fn):
+    """Обёртка хендлера: время и исключения в метрики."""
+    name = fn.__name__
+
+    @wraps(fn)
+    async def wrapper(update, ctx):
+        t = time.perf_counter()
+        try:
+            return await fn(update, ctx)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - t, name)
+    return wrapper
+
+
+async def _metrics_http(r: asyncio.StreamReader, w: asyncio.StreamWriter):
+    # любой путь — одна и та же страница; больше тут ничего нет
+    try:
+        await r.readuntil(b"\r\n\r\n")
+        body = ("\n".join(line for m in _registry for line in m.render())
+                + "\n").encode()
+        w.write(b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4\r\n"
+                b"Content-Length: %d\r\nConnection: close\r\n\r\n"
+                % len(body) + body)
+        await w.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+            ConnectionError):
+        pass
+    finally:
+        w.close()
+
+
+async def start_metrics():
+    if not METRICS_PORT:
+        return None
+    srv = await asyncio.start_server(_metrics_http, METRICS_LISTEN,
+                                     METRICS_PORT)
+    log.info("метрики: http://%s:%d/metrics", METRICS_LISTEN, METRICS_PORT)
+    return srv
+
+# ══════════════════════════════════════════════════════════
+#  ДИАГНОСТИКА
+# ══════════════════════════════════════════════════════════
+# Сторож: задача в loop делает отметку каждые STALL_TICK, отдельный поток
+# смотрит, давно ли была последняя. Если loop стоит дольше STALL_MS, в лог
+# идёт стек его потока (видно, какой синхронный вызов держит) и апдейт,
+# который сейчас обрабатывается.
+# Профайлер: по SIGUSR1 PROFILE_SECONDS снимаем стеки всех потоков и пишем
+# их в PROFILE_DIR в формате .folded (flamegraph.pl, speedscope).
+
+LOOP_LAG = Histogram("bot_loop_lag_seconds", "Опоздание event loop")
+STALLS = Counter("bot_loop_stalls_total",
+                 "Остановки event loop дольше STALL_MS")
+
+# задача -> апдейт, который она сейчас обрабатывает (ChatOrderedProcessor)
+_running = {}
+
+
+def describe(update) -> str:
+    """Апдейт одной строкой для лога."""
+    if not isinstance(update, Update):
+        return repr(update)[:200]
+    parts = [f"#{update.update_id}"]
+    if update.effective_chat:
+        parts.append(f"chat={update.effective_chat.id}")
+    if update.effective_user:
+        parts.append(f"user={update.effective_user.id}")
+    if update.callback_query:
+        parts.append(f"data={update.callback_query.data!r}")
+    elif update.effective_message and update.effective_message.text:
+        parts.append(f"text={update.effective_message.text[:50]!r}")
+    return " ".join(parts)
+
+
+class Watchdog:
+    """Сторож event loop; start() и stop() — из самого loop."""
+
+    def __init__(self, stall_ms: int = STALL_MS):
+        self.limit = stall_ms / 1000
+        self._beat = time.monotonic()
+        self._stop = threading.Event()
+        self._task = None
+
+    def start(self):
+        if not self.limit:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._tid = threading.get_ident()
+        self._task = asyncio.create_task(self._heartbeat())
+        threading.Thread(target=self._watch, name="watchdog",
+                         daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+
+    async def _heartbeat(self):
+        while True:
+            t = self._beat = time.monotonic()
+            await asyncio.sleep(STALL_TICK)
+            lag = max(time.monotonic() - t - STALL_TICK, 0)
+            LOOP_LAG.observe(lag)
+            if lag >= self.limit:
+                log.warning("event loop отпустило через %.0f мс", lag * 1000)
+
+    def _current(self) -> str:
+        task = asyncio.current_task(self._loop)
+        if task is None:
+            return "—"
+        # _running меняет поток loop: одна операция, без проверки «in»
+        update = _running.get(task)
+        if update is not None:
+            return describe(update)
+        return f"задача {task.get_name()} ({task.get_coro().__qualname__})"
+
+    def _watch(self):
+        seen = None
+        while not self._stop.wait(STALL_TICK):
+            beat = self._beat
+            if beat == seen or time.monotonic() - beat < self.limit:
+                continue
+            frame = sys._current_frames().get(self._tid)
+            what = self._current()
+            if frame is None or self._beat != beat:
+                continue    # пока снимали, loop уже отпустило
+            seen = beat
+            STALLS.inc()
+            log.warning("event loop стоит %.0f мс, апдейт: %s\n%s",
+                        (time.monotonic() - beat) * 1000, what,
+                        "".join(traceback.format_stack(frame)).rstrip())
+
+
+_profiling = threading.Lock()
+
+
+def profile(seconds: float = PROFILE_SECONDS,
+            hz: int = PROFILE_HZ) -> Optional[str]:
+    """Снимать стеки всех потоков seconds секунд, вернуть путь к .folded.
+
+    Блокирует — звать из отдельного потока. None, если профиль уже пишется.
+    """
+    if not _profiling.acquire(blocking=False):
+        return None
+    try:
+        me = threading.get_ident()
+        stacks = {}
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for tid, frame in sys._current_frames().items():
+                if tid == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    co = frame.f_code
+                    stack.append(f"{co.co_name} ("
+                                 f"{os.path.basename(co.co_filename)}:"
+                                 f"{co.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(tid, str(tid)))
+                key = ";".join(reversed(stack))
+                stacks[key] = stacks.get(key, 0) + 1
+            time.sleep(1 / hz)
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, time.strftime("%Y%m%d-%H%M%S")
+                            + f"-{os.getpid()}.folded")
+        with open(path, "w") as f:
+            for key, n in sorted(stacks.items()):
+                f.write(f"{key} {n}\n")
+        return path
+    finally:
+        _profiling.release()
+
+
+def start_profile():
+    """Обработчик SIGUSR1: профиль в фоновом потоке, путь — в лог."""
+    if _profiling.locked():
+        log.warning("профайлер уже работает")
+        return
+
+    def run():
+        path = profile(PROFILE_SECONDS, PROFILE_HZ)
+        if path:
+            log.info("профиль записан: %s", path)
+    log.info("профайлер: %.0f с, %d снимков/с", PROFILE_SECONDS, PROFILE_HZ)
+    threading.Thread(target=run, name="profiler", daemon=True).start()
+
+
+# этапы запуска: отметки perf_counter, первая — сразу после импортов
+_marks = [("импорты", _t_imports)]
+
+
+def startup_mark(stage: str):
+    """Закончился этап stage (от предыдущей отметки до сейчас)."""
+    _marks.append((stage, time.perf_counter()))
+
+
+def _since_exec() -> Optional[float]:
+    """Секунд с запуска процесса; None, если нет /proc."""
+    try:
+        with open("/proc/self/stat") as f:
+            ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        return (time.clock_gettime(time.CLOCK_BOOTTIME)
+                - ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def startup_report(stage: str):
+    """Закрыть последний этап и записать разбивку запуска в лог."""
+    startup_mark(stage)
+    parts = [f"{name} {(t - prev) * 1000:.0f}" for (_, prev), (name, t)
+             in zip(_marks, _marks[1:])]
+    total = _marks[-1][1] - _marks[0][1]
+    since = _since_exec()
+    if since is not None:
+        # интерпретатор и импорты — всё, что было до первой отметки
+        before = since - (time.perf_counter() - _marks[0][1])
+        parts.insert(0, f"python и импорты {before * 1000:.0f}")
+        total += before
+    log.info("запуск за %.0f мс: %s", total * 1000, ", ".join(parts))
+
 # ══════════════════════════════════════════════════════════
 #  БАЗА ДАННЫХ
 # ══════════════════════════════════════════════════════════
 
+class Database:
+    """Постоянный писатель + пул read-only читателей к одному файлу."""
+
+    def __init__(self, path: str, readers: int = DB_READERS):
+        self.path = path
+        self._wlock = threading.Lock()
+        self._writer = self._connect(path)
+        self._writer.execute("PRAGMA journal_mode=WAL")
+        self._writer.execute("PRAGMA synchronous=NORMAL")
+        self._readers = queue.LifoQueue()
+        for _ in range(readers):
+            self._readers.put(
+                self._connect(f"file:{path}?mode=ro", uri=True))
+
+    @staticmethod
+    def _connect(target: str, **kw) -> sqlite3.Connection:
+        c = sqlite3.connect(
+            target, check_same_thread=False,
+            cached_statements=DB_STMT_CACHE, **kw)
+        c.execute(f"PRAGMA cache_size=-{DB_CACHE_KB}")
+        c.execute(f"PRAGMA mmap_size={DB_MMAP_BYTES}")
+        return c
+
+    @contextmanager
+    def read(self):
+        c = self._readers.get()
+        try:
+            yield c
+        finally:
+            self._readers.put(c)
+
+    @contextmanager
+    def write(self):
+        # одна транзакция: commit при выходе, rollback при исключении
+        with self._wlock, self._writer as c:
+            yield c
+
+    def close(self):
+        with self._wlock:
+            self._writer.close()
+        while not self._readers.empty():
+            self._readers.get_nowait().close()
+
+
+db: Optional[Database] = None      # общий файл: known_users, media_cache
+shards: list = []                  # Database на каждый шард, db при одном
+# все обращения к SQLite идут сюда, а не в event loop
+_db_pool: Optional[ThreadPoolExecutor] = None
+
+
+async def run_db(fn, *args):
+    """Выполнить хелпер БД в пуле потоков и дождаться результата."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _db_pool, _timed_db, fn, args, time.perf_counter())
+
+
+def _timed_db(fn, args, queued):
+    t = time.perf_counter()
+    DB_WAIT.observe(t - queued)
+    try:
+        return fn(*args)
+    finally:
+        DB_SECONDS.observe(time.perf_counter() - t, fn.__name__)
+
+
+# PRAGMA user_version = число применённых миграций.
+# Только дописывать в конец, старые не менять!
+MIGRATIONS = [
+    # 1: исходная схема
+    """
+    CREATE TABLE IF NOT EXISTS known_users (
+        user_id    INTEGER PRIMARY KEY,
+        username   TEXT,
+        first_name TEXT,
+        last_name  TEXT
+    );
+    CREATE TABLE IF NOT EXISTS marriages (
+        id             INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id        INTEGER NOT NULL,
+        user1_id       INTEGER NOT NULL,
+        user1_name     TEXT    NOT NULL,
+        user1_un       TEXT,
+        user2_id       INTEGER NOT NULL,
+        user2_name     TEXT    NOT NULL,
+        user2_un       TEXT,
+        married_at     TEXT    NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS pending (
+        id             INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id        INTEGER NOT NULL,
+        initiator_id   INTEGER NOT NULL,
+        u1_id          INTEGER NOT NULL,
+        u1_name        TEXT,
+        u1_un          TEXT,
+        u2_id          INTEGER NOT NULL,
+        u2_name        TEXT,
+        u2_un          TEXT,
+        u1_ok          INTEGER,
+        u2_ok          INTEGER,
+        msg_id         INTEGER,
+        created_at     TEXT    NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS msg_cnt (
+        user_id INTEGER,
+        chat_id INTEGER,
+        cnt     INTEGER DEFAULT 0,
+        PRIMARY KEY (user_id, chat_id)
+    );
+    """,
+    # 2: индексы под горячие запросы (get_marriage, pending_for,
+    #    истечение pending, /marriages, find_user)
+    """
+    CREATE INDEX IF NOT EXISTS marriages_chat_u1
+        ON marriages(chat_id, user1_id);
+    CREATE INDEX IF NOT EXISTS marriages_chat_u2
+        ON marriages(chat_id, user2_id);
+    CREATE INDEX IF NOT EXISTS marriages_chat_date
+        ON marriages(chat_id, married_at);
+    CREATE INDEX IF NOT EXISTS pending_chat_u1 ON pending(chat_id, u1_id);
+    CREATE INDEX IF NOT EXISTS pending_chat_u2 ON pending(chat_id, u2_id);
+    CREATE INDEX IF NOT EXISTS pending_created ON pending(created_at);
+    CREATE INDEX IF NOT EXISTS known_users_un ON known_users(username);
+    """,
+    # 3: file_id загруженных в Telegram картинок; sig — чем она была
+    """
+    CREATE TABLE IF NOT EXISTS media_cache (
+        key     TEXT PRIMARY KEY,
+        sig     TEXT NOT NULL,
+        file_id TEXT NOT NULL
+    );
+    """,
+    # 4: настройки хранилища (сколько шардов) — в общем файле
+    """
+    CREATE TABLE IF NOT EXISTS settings (
+        key   TEXT PRIMARY KEY,
+        value
+    );
+    """,
+    # 5: сообщения по суткам и неделям и состав топов /top:
+    #    board d/w — участники за сутки/неделю bucket, a — за всё время,
+    #    c — пары (id брака) по сумме сообщений; в каждом по 10 мест.
+    #    Итоги не дублируются — они в msg_*. a и c сразу заполняются
+    """
+    CREATE TABLE IF NOT EXISTS msg_daily (
+        chat_id INTEGER,
+        day     INTEGER,
+        user_id INTEGER,
+        cnt     INTEGER DEFAULT 0,
+        PRIMARY KEY (chat_id, day, user_id)
+    );
+    CREATE INDEX IF NOT EXISTS msg_daily_day ON msg_daily(day);
+    CREATE TABLE IF NOT EXISTS msg_weekly (
+        chat_id INTEGER,
+        week    INTEGER,
+        user_id INTEGER,
+        cnt     INTEGER DEFAULT 0,
+        PRIMARY KEY (chat_id, week, user_id)
+    );
+    CREATE INDEX IF NOT EXISTS msg_weekly_week ON msg_weekly(week);
+    CREATE TABLE IF NOT EXISTS top (
+        chat_id INTEGER,
+        board   TEXT,
+        bucket  INTEGER,
+        id      INTEGER,
+        PRIMARY KEY (chat_id, board, bucket, id)
+    );
+    CREATE INDEX IF NOT EXISTS top_bucket ON top(board, bucket);
+    INSERT INTO top
+        SELECT chat_id, 'a', 0, user_id FROM (
+            SELECT chat_id, user_id, cnt, row_number() OVER (
+                PARTITION BY chat_id ORDER BY cnt DESC) AS rn
+            FROM msg_cnt)
+        WHERE rn <= 10;
+    INSERT INTO top
+        SELECT chat_id, 'c', 0, id FROM (
+            SELECT chat_id, id, score, row_number() OVER (
+                PARTITION BY chat_id ORDER BY score DESC) AS rn
+            FROM (SELECT m.chat_id, m.id,
+                         IFNULL(a.cnt, 0) + IFNULL(b.cnt, 0) AS score
+                  FROM marriages m
+                  LEFT JOIN msg_cnt a
+                      ON a.user_id = m.user1_id AND a.chat_id = m.chat_id
+                  LEFT JOIN msg_cnt b
+                      ON b.user_id = m.user2_id AND b.chat_id = m.chat_id))
+        WHERE rn <= 10;
+    """,
+]
+
+# id в marriages/pending уникальны на всех шардах: шард i выдаёт их
+# из своего диапазона [база + i*SPAN, база + (i+1)*SPAN)
+SHARD_ID_SPAN = 10 ** 12
+
+_MARRIAGES_PAGE_SQL = (
+    "SELECT id, married_at, user1_name, user1_un, user2_name, user2_un, "
+    "CAST(julianday('now') - julianday(married_at) AS INTEGER) "
+    "FROM marriages WHERE chat_id=? {cond} "
+    "ORDER BY married_at {order}, id {order} LIMIT ?"
+)
+
+# топ пар чата заново — только после развода пары из топа; сортирует
+# пары одного чата, поэтому не в HOT_QUERIES
+_TOP_COUPLES_REBUILD_SQL = (
+    "INSERT INTO top "
+    "SELECT m.chat_id, 'c', 0, m.id "
+    "FROM marriages m "
+    "LEFT JOIN msg_cnt a ON a.user_id=m.user1_id AND a.chat_id=m.chat_id "
+    "LEFT JOIN msg_cnt b ON b.user_id=m.user2_id AND b.chat_id=m.chat_id "
+    "WHERE m.chat_id=? "
+    "ORDER BY IFNULL(a.cnt, 0) + IFNULL(b.cnt, 0) DESC LIMIT ?"
+)
+
+# все топы заново, по TOP_SIZE мест — после загрузки данных целиком
+_TOPS_REBUILD_SQL = [
+    "DELETE FROM top",
+    *(f"INSERT INTO top SELECT chat_id, '{board}', b, user_id FROM ("
+      f"SELECT chat_id, {bucket} AS b, user_id, row_number() OVER ("
+      f"PARTITION BY chat_id, {bucket} ORDER BY cnt DESC) AS rn "
+      f"FROM {table}) WHERE rn <= :k"
+      for board, bucket, table in (("a", "0", "msg_cnt"),
+                                   ("d", "day", "msg_daily"),
+                                   ("w", "week", "msg_weekly"))),
+    "INSERT INTO top SELECT chat_id, 'c', 0, id FROM ("
+    "SELECT m.chat_id, m.id, row_number() OVER ("
+    "PARTITION BY m.chat_id "
+    "ORDER BY IFNULL(a.cnt, 0) + IFNULL(b.cnt, 0) DESC) AS rn "
+    "FROM marriages m "
+    "LEFT JOIN msg_cnt a ON a.user_id=m.user1_id AND a.chat_id=m.chat_id "
+    "LEFT JOIN msg_cnt b ON b.user_id=m.user2_id AND b.chat_id=m.chat_id"
+    ") WHERE rn <= :k",
+]
+
+# состав топа с текущими итогами; по TOP_SIZE строк, сортирует Python
+_TOP_SQL = ("SELECT t.id, {score} FROM top t {join} "
+            "WHERE t.chat_id=? AND t.board='{board}' AND t.bucket=?")
+
+# запросы, которые не должны делать полный проход по таблице
+HOT_QUERIES = {
+    "find_user": "SELECT user_id,username,first_name,last_name "
+                 "FROM known_users WHERE username=?",
+    # OR раскрыт по chat_id, чтобы оба индекса работали как seek
+    "get_marriage": "SELECT * FROM marriages "
+                    "WHERE (chat_id=? AND user1_id=?) "
+                    "OR (chat_id=? AND user2_id=?)",
+    # /marriages: keyset-страницы по (married_at, id), дни считает SQLite
+    "marriages_first": _MARRIAGES_PAGE_SQL.format(
+        cond="", order="ASC"),
+    "marriages_next": _MARRIAGES_PAGE_SQL.format(
+        cond="AND (married_at, id) > (?, ?)", order="ASC"),
+    "marriages_prev": _MARRIAGES_PAGE_SQL.format(
+        cond="AND (married_at, id) < (?, ?)", order="DESC"),
+    "pending_for": "SELECT 1 FROM pending "
+                   "WHERE ((chat_id=? AND u1_id=?) "
+                   "OR (chat_id=? AND u2_id=?)) "
+                   "AND created_at>=datetime('now',?)",
+    # abs(chat_id) % k = i — то же, что shard_of: только чаты _owner
+    "expire_pending": "DELETE FROM pending WHERE id IN ("
+                      "SELECT id FROM pending "
+                      "WHERE created_at<datetime('now',?) "
+                      "AND abs(chat_id) % ? = ? LIMIT ?) "
+                      "RETURNING chat_id, msg_id",
+    "msg_cnt": "SELECT cnt FROM msg_cnt WHERE user_id=? AND chat_id=?",
+    "top_a": _TOP_SQL.format(
+        board="a", score="m.cnt",
+        join="JOIN msg_cnt m ON m.user_id=t.id AND m.chat_id=t.chat_id"),
+    "top_d": _TOP_SQL.format(
+        board="d", score="m.cnt",
+        join="JOIN msg_daily m ON m.chat_id=t.chat_id AND m.day=t.bucket "
+             "AND m.user_id=t.id"),
+    "top_w": _TOP_SQL.format(
+        board="w", score="m.cnt",
+        join="JOIN msg_weekly m ON m.chat_id=t.chat_id "
+             "AND m.week=t.bucket AND m.user_id=t.id"),
+    "top_c": _TOP_SQL.format(
+        board="c",
+        score="IFNULL(a.cnt, 0) + IFNULL(b.cnt, 0), "
+              "m.user1_name, m.user1_un, m.user2_name, m.user2_un",
+        join="JOIN marriages m ON m.id=t.id "
+             "LEFT JOIN msg_cnt a ON a.user_id=m.user1_id "
+             "AND a.chat_id=m.chat_id "
+             "LEFT JOIN msg_cnt b ON b.user_id=m.user2_id "
+             "AND b.chat_id=m.chat_id"),
+    "expire_daily": "DELETE FROM msg_daily WHERE rowid IN ("
+                    "SELECT rowid FROM msg_daily WHERE day<? "
+                    "AND abs(chat_id) % ? = ? LIMIT ?)",
+    "expire_weekly": "DELETE FROM msg_weekly WHERE rowid IN ("
+                     "SELECT rowid FROM msg_weekly WHERE week<? "
+                     "AND abs(chat_id) % ? = ? LIMIT ?)",
+    "expire_top": "DELETE FROM top WHERE rowid IN ("
+                  "SELECT rowid FROM top WHERE board=? AND bucket<? "
+                  "AND abs(chat_id) % ? = ? LIMIT ?)",
+}
+
+
+def migrate(c: sqlite3.Connection, path: str = DB_PATH) -> int:
+    """Применить недостающие миграции; вернуть версию до них."""
+    ver = c.execute("PRAGMA user_version").fetchone()[0]
+    for v, sql in enumerate(MIGRATIONS[ver:], ver + 1):
+        c.executescript(f"BEGIN;{sql};PRAGMA user_version={v};COMMIT;")
+        log.info("БД %s: миграция до версии %d", path, v)
+    return ver
+
+
+def shard_of(cid: int, n: int) -> int:
+    return abs(cid) % n
+
+
+# (i, k): этот процесс — обработчик i из k (режим WORKERS), иначе (0, 1).
+# Фоновые чистки трогают только его чаты: правки идут через его outbox,
+# а при WORKERS == DB_SHARDS в каждый шард пишет один процесс
+_owner = (0, 1)
+
+
+def owned_shards() -> list:
+    """Шарды, в которых могут быть чаты этого процесса."""
+    i, k = _owner
+    if k > 1 and len(shards) == k:
+        return [shards[i]]
+    return list(dict.fromkeys(shards))
+
+
+def shard_paths(n: int) -> list:
+    if n == 1:
+        return [DB_PATH]
+    base, ext = os.path.splitext(DB_PATH)
+    return [f"{base}.s{i}{ext}" for i in range(n)]
+
+
+def shard_layout(c: sqlite3.Connection) -> Optional[int]:
+    r = c.execute("SELECT value FROM settings WHERE key='shards'").fetchone()
+    return r[0] if r else None
+
+
+def seed_ids(c: sqlite3.Connection, start: int):
+    """Следующие id в marriages/pending будут больше start."""
+    c.execute("DELETE FROM sqlite_sequence "
+              "WHERE name IN ('marriages', 'pending')")
+    c.executemany("INSERT INTO sqlite_sequence(name, seq) VALUES(?, ?)",
+                  [("marriages", start), ("pending", start)])
+
+
+def full_scans(c: sqlite3.Connection) -> list:
+    """Горячие запросы, у которых в плане есть скан или сортировка.
+
+    SCAN по индексу (в том числе COVERING) — тоже полный проход, только
+    по индексу, поэтому плох любой SCAN.
+    """
+    bad = []
+    for name, sql in HOT_QUERIES.items():
+        args = (None,) * sql.count("?")
+        for row in c.execute("EXPLAIN QUERY PLAN " + sql, args):
+            detail = row[-1]
+            if detail.startswith("SCAN ") or "TEMP B-TREE" in detail:
+                bad.append(f"{name}: {detail}")
+    return bad
+
+
 def init_db():
-    with sqlite3.connect(DB_PATH) as con:
-        con.executescript("""
-        CREATE TABLE IF NOT EXISTS known_users (
-            user_id    INTEGER PRIMARY KEY,
-            username   TEXT,
-            first_name TEXT,
-            last_name  TEXT
-        );
-        CREATE TABLE IF NOT EXISTS marriages (
-            id             INTEGER PRIMARY KEY AUTOINCREMENT,
-            chat_id        INTEGER NOT NULL,
-            user1_id       INTEGER NOT NULL,
-            user1_name     TEXT    NOT NULL,
-            user1_un       TEXT,
-            user2_id       INTEGER NOT NULL,
-            user2_name     TEXT    NOT NULL,
-            user2_un       TEXT,
-            married_at     TEXT    NOT NULL
-        );
-        CREATE TABLE IF NOT EXISTS pending (
-            id             INTEGER PRIMARY KEY AUTOINCREMENT,
-            chat_id        INTEGER NOT NULL,
-            initiator_id   INTEGER NOT NULL,
-            u1_id          INTEGER NOT NULL,
-            u1_name        TEXT,
-            u1_un          TEXT,
-            u2_id          INTEGER NOT NULL,
-            u2_name        TEXT,
-            u2_un          TEXT,
-            u1_ok          INTEGER,
-            u2_ok          INTEGER,
-            msg_id         INTEGER,
-            created_at     TEXT    NOT NULL
-        );
-        CREATE TABLE IF NOT EXISTS msg_cnt (
-            user_id INTEGER,
-            chat_id INTEGER,
-            cnt     INTEGER DEFAULT 0,
-            PRIMARY KEY (user_id, chat_id)
-        );
-        """)
-
-
-def _db():
-    return sqlite3.connect(DB_PATH)
+    global db, shards, _db_pool
+    db = Database(DB_PATH)
+    with db.write() as c:
+        fresh = migrate(c) == 0
+        n = shard_layout(c) or (DB_SHARDS if fresh else 1)
+        if n != DB_SHARDS:
+            raise SystemExit(
+                f"БД разложена на {n} шард(ов), а DB_SHARDS={DB_SHARDS}: "
+                f"python reshard.py {DB_SHARDS}")
+        c.execute("INSERT OR REPLACE INTO settings VALUES('shards', ?)",
+                  (n,))
+    shards = [db] if n == 1 else [Database(p) for p in shard_paths(n)]
+    for i, s in enumerate(shards):
+        with s.write() as c:
+            if migrate(c, s.path) == 0 and s is not db:
+                seed_ids(c, i * SHARD_ID_SPAN)
+            for problem in full_scans(c):
+                log.warning("БД: полный проход в горячем запросе — %s",
+                            problem)
+    # по потоку на каждого писателя, читатели делят остальные
+    _db_pool = ThreadPoolExecutor(DB_READERS + len(set(shards) | {db}),
+                                  thread_name_prefix="db")
+
+
+def shard(cid: int) -> Database:
+    """Файл, где лежат браки, предложения и счётчики чата cid."""
+    return shards[shard_of(cid, len(shards))]
+
+
+def close_db():
+    for s in shards:
+        if s is not db:
+            s.close()
+    db.close()
 
 # ══════════════════════════════════════════════════════════
 #  ХЕЛПЕРЫ
 # ══════════════════════════════════════════════════════════
 
+class LRU(OrderedDict):
+    """OrderedDict, вытесняющий давно не использованные ключи."""
+
+    def __init__(self, size: int):
+        super().__init__()
+        self.size = size
+
+    def get(self, k, default=None):
+        if k not in self:
+            return default
+        self.move_to_end(k)
+        return self[k]
+
+    def put(self, k, v):
+        self[k] = v
+        self.move_to_end(k)
+        while len(self) > self.size:
+            self.popitem(last=False)
+
+
+class WriteBehind:
+    """Буфер дельт msg_cnt, активности и профилей known_users.
+
+    Пишется пачкой; в той же транзакции обновляются топы /top.
+    """
+
+    def __init__(self):
+        # lock защищает словари: пишет event loop, сбрасывает поток БД.
+        # Под ним — только работа со словарями, запросы к БД идут мимо
+        self.lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self.cnt = {}     # (uid, cid) -> сколько сообщений ещё не в БД
+        self.days = {}    # (uid, cid, сутки) -> то же по суткам
+        self.users = {}   # uid -> строка known_users
+        # пачка, которая сейчас пишется, — видна читателям до commit
+        self._fl_cnt, self._fl_users = {}, {}
+        self._fl_days = {}
+        # seqlock вокруг commit пачки: нечётное — пачка, возможно, уже
+        # в БД, но ещё и в _fl_*; после снятия пачки снова чётное
+        self.gen = 0
+
+    def __len__(self):
+        return len(self.cnt) + len(self.users)
+
+    def add_msg(self, uid: int, cid: int):
+        k = (uid, cid)
+        d = (uid, cid, day_of())
+        with self.lock:
+            self.cnt[k] = self.cnt.get(k, 0) + 1
+            self.days[d] = self.days.get(d, 0) + 1
+
+    def add_user(self, row: tuple):
+        with self.lock:
+            self.users[row[0]] = row
+
+    def read(self, query, merge):
+        """query() — чтение БД без lock, merge(итог query) — под lock.
+
+        Если между ними записалась пачка, БД и буфер могут посчитать
+        одно и то же дважды или ни разу — тогда чтение повторяется.
+        """
+        while True:
+            with self.lock:
+                gen = self.gen
+            if gen % 2 == 0:
+                r = query()
+                with self.lock:
+                    if self.gen == gen:
+                        return merge(r)
+            time.sleep(0.001)
+
+    # ── вызывать под self.lock ──
+    def cnt_delta(self, uid: int, cid: int) -> int:
+        k = (uid, cid)
+        return self.cnt.get(k, 0) + self._fl_cnt.get(k, 0)
+
+    def user(self, uid: int) -> Optional[tuple]:
+        return self.users.get(uid) or self._fl_users.get(uid)
+
+    def user_by_un(self, un: str) -> Optional[tuple]:
+        for src in (self.users, self._fl_users):
+            for row in src.values():
+                if row[1] == un and self.user(row[0]) is row:
+                    return row
+        return None
+
+    def flush(self):
+        with self._flush_lock:
+            with self.lock:
+                if not self:
+                    return
+                cnt, users, days = self.cnt, self.users, self.days
+                self.cnt, self.users, self.days = {}, {}, {}
+                self._fl_cnt, self._fl_users = cnt, users
+                self._fl_days = days
+            # по транзакции на файл: профили — в общий, счётчики — в шард
+            jobs = {}
+            if users:
+                jobs[db] = (list(users), [], [])
+            for k in cnt:
+                jobs.setdefault(shard(k[1]), ([], [], []))[1].append(k)
+            for k in days:
+                jobs.setdefault(shard(k[1]), ([], [], []))[2].append(k)
+            for d, (uids, keys, dkeys) in jobs.items():
+                self._flush_to(d, uids, keys, dkeys)
+
+    def _flush_to(self, d: Database, uids: list, keys: list, dkeys: list):
+        try:
+            with d.write() as c:
+                # upsert без REPLACE: неизменённые строки не трогаем
+                c.executemany(
+                    "INSERT INTO known_users VALUES(?,?,?,?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET "
+                    "username=excluded.username, "
+                    "first_name=excluded.first_name, "
+                    "last_name=excluded.last_name "
+                    "WHERE (username,first_name,last_name) IS NOT "
+                    "(excluded.username,excluded.first_name,"
+                    "excluded.last_name)",
+                    [self._fl_users[u] for u in uids])
+                boards = add_messages(
+                    c, [(k, self._fl_cnt[k]) for k in keys],
+                    [(k, self._fl_days[k]) for k in dkeys])
+                # commit (с checkpoint'ом может быть долгим) — без lock,
+                # читатели видят нечётное gen и ждут снятия пачки
+                with self.lock:
+                    self.gen += 1
+                c.commit()
+                # ещё под замком писателя: свадьба и развод выкидывают
+                # топ из _tops под ним же, старая копия их не перезапишет
+                if len(_tops) > TOP_CACHE:
+                    _tops.clear()
+                _tops.update(boards)
+        except sqlite3.Error:
+            log.exception("write-behind: сброс в %s не удался, "
+                          "повторим позже", d.path)
+            # вернуть несохранённое, не затирая более свежие данные
+            with self.lock:
+                for k in keys:
+                    self.cnt[k] = self.cnt.get(k, 0) + self._fl_cnt.pop(k)
+                for k in dkeys:
+                    self.days[k] = self.days.get(k, 0) + self._fl_days.pop(k)
+                for u in uids:
+                    self.users.setdefault(u, self._fl_users.pop(u))
+                self.gen += self.gen % 2
+            # копии топов этих чатов могли разойтись с БД — перечитать
+            cids = {k[1] for k in keys} | {k[1] for k in dkeys}
+            for key in [k for k in _tops if k[0] in cids]:
+                _tops.pop(key, None)
+            return
+        with self.lock:
+            for u in uids:
+                del self._fl_users[u]
+            for k in keys:
+                del self._fl_cnt[k]
+            for k in dkeys:
+                del self._fl_days[k]
+            self.gen += 1
+
+
+wb = WriteBehind()
+
+
+async def _flusher():
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        await run_db(wb.flush)
+
+
+class UserCache:
+    """LRU профилей known_users: uid -> строка, плюс индекс по нику."""
+
+    def __init__(self, size: int = USER_CACHE_SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        self._rows = OrderedDict()
+        self._by_un = {}
+
+    def get(self, uid: int) -> Optional[tuple]:
+        with self._lock:
+            row = self._rows.get(uid)
+            if row:
+                self._rows.move_to_end(uid)
+            return row
+
+    def by_un(self, un: str) -> Optional[tuple]:
+        with self._lock:
+            uid = self._by_un.get(un)
+            return self._rows[uid] if uid is not None else None
+
+    def put(self, row: tuple):
+        uid, un = row[0], row[1]
+        with self._lock:
+            old = self._rows.pop(uid, None)
+            if old and self._by_un.get(old[1]) == uid:
+                del self._by_un[old[1]]
+            self._rows[uid] = row
+            if un:
+                self._by_un[un] = uid
+            while len(self._rows) > self.size:
+                _, ev = self._rows.popitem(last=False)
+                if self._by_un.get(ev[1]) == ev[0]:
+                    del self._by_un[ev[1]]
+
+
+user_cache = UserCache()
+
+
 def cache_user(u):
     if not u or u.is_bot:
         return
-    with _db() as c:
-        c.execute(
-            "INSERT OR REPLACE INTO known_users VALUES(?,?,?,?)",
-            (u.id, (u.username or "").lower(), u.first_name, u.last_name or ""),
-        )
+    row = (u.id, (u.username or "").lower(), u.first_name, u.last_name or "")
+    # ник и имя меняются редко — пишем в БД только изменения
+    if user_cache.get(u.id) == row:
+        return
+    user_cache.put(row)
+    wb.add_user(row)
 
 
 def find_user(username: str) -> Optional[dict]:
     un = username.lower().lstrip("@")
     if not un:
         return None
-    with _db() as c:
-        r = c.execute(
-            "SELECT user_id,username,first_name FROM known_users "
-            "WHERE LOWER(username)=?", (un,)
-        ).fetchone()
+    r = user_cache.by_un(un)
+    CACHE.inc("users", "hit" if r else "miss")
+    if r:
+        return {"id": r[0], "un": r[1], "name": r[2]}
+    def query():
+        with db.read() as c:
+            return c.execute(HOT_QUERIES["find_user"], (un,)).fetchone()
+
+    def merge(r):
+        # юзер мог сменить ник — в памяти уже новая версия
+        if r and (wb.user(r[0]) or user_cache.get(r[0])):
+            r = None
+        elif r:
+            user_cache.put(r)
+        return wb.user_by_un(un) or r
+
+    with wb.lock:
+        r = wb.user_by_un(un)
+    if not r:
+        r = wb.read(query, merge)
     return {"id": r[0], "un": r[1], "name": r[2]} if r else None
 
 
 def get_marriage(uid: int, cid: int) -> Optional[dict]:
-    with _db() as c:
+    with shard(cid).read() as c:
         r = c.execute(
-            "SELECT * FROM marriages WHERE chat_id=? "
-            "AND (user1_id=? OR user2_id=?)", (cid, uid, uid)
-        ).fetchone()
+            HOT_QUERIES["get_marriage"], (cid, uid, cid, uid)).fetchone()
     if not r:
         return None
     return dict(
@@ -140,34 +1188,356 @@ def get_marriage(uid: int, cid: int) -> Optional[dict]:
     )
 
 
+def marriages_page(cid: int, cursor: Optional[tuple] = None,
+                   back: bool = False) -> tuple:
+    """Страница пар после/до cursor=(married_at, id) -> (строки, есть_ещё).
+
+    Строка: (id, married_at, u1n, u1u, u2n, u2u, дней вместе).
+    """
+    n = MARRIAGES_PAGE + 1
+    with shard(cid).read() as c:
+        if cursor is None:
+            rows = c.execute(HOT_QUERIES["marriages_first"], (cid, n))
+        elif back:
+            rows = c.execute(HOT_QUERIES["marriages_prev"], (cid, *cursor, n))
+        else:
+            rows = c.execute(HOT_QUERIES["marriages_next"], (cid, *cursor, n))
+        rows = rows.fetchall()
+    more = len(rows) > MARRIAGES_PAGE
+    rows = rows[:MARRIAGES_PAGE]
+    if back:
+        rows.reverse()
+    return rows, more
+
+
 def pending_for(uid: int, cid: int) -> bool:
-    with _db() as c:
-        c.execute(
-            "DELETE FROM pending WHERE created_at<datetime('now','-1 day')"
-        )
+    # просроченные, но ещё не удалённые sweeper'ом не считаются
+    with shard(cid).read() as c:
         return c.execute(
-            "SELECT 1 FROM pending WHERE chat_id=? "
-            "AND (u1_id=? OR u2_id=?)", (cid, uid, uid)
+            HOT_QUERIES["pending_for"], (cid, uid, cid, uid, PENDING_TTL)
         ).fetchone() is not None
 
 
+def expire_pending(limit: int) -> list:
+    """Удалить до limit просроченных предложений, вернуть (chat_id, msg_id)."""
+    i, k = _owner
+    rows = []
+    for s in owned_shards():
+        if len(rows) >= limit:
+            break
+        with s.write() as c:
+            rows += c.execute(HOT_QUERIES["expire_pending"],
+                              (PENDING_TTL, k, i,
+                               limit - len(rows))).fetchall()
+    return rows
+
+
+def create_pending(cid: int, init_id: int, u1: dict, u2: dict,
+                   u1_ok: Optional[int] = None) -> int:
+    with shard(cid).write() as c:
+        return c.execute(
+            "INSERT INTO pending"
+            "(chat_id,initiator_id,u1_id,u1_name,u1_un,"
+            "u2_id,u2_name,u2_un,u1_ok,u2_ok,created_at) "
+            "VALUES(?,?,?,?,?,?,?,?,?,NULL,datetime('now'))",
+            (cid, init_id,
+             u1["id"], u1["name"], u1["un"],
+             u2["id"], u2["name"], u2["un"], u1_ok)).lastrowid
+
+
+def set_pending_msg(cid: int, pid: int, msg_id: int):
+    with shard(cid).write() as c:
+        c.execute("UPDATE pending SET msg_id=? WHERE id=?", (msg_id, pid))
+
+
+_PENDING_LIVE_SQL = ("SELECT * FROM pending "
+                     "WHERE id=? AND created_at>=datetime('now',?)")
+
+
+def accept_pending(cid: int, pid: int, uid: int) -> Optional[dict]:
+    """Согласие uid; если согласны оба — сразу свадьба.
+
+    None — предложения нет, оно просрочено или кто-то из пары уже в браке.
+    """
+    with shard(cid).write() as c:
+        # просроченное sweeper мог ещё не удалить — для нас его уже нет
+        row = c.execute(_PENDING_LIVE_SQL, (pid, PENDING_TTL)).fetchone()
+        if not row:
+            return None
+        # 0:id 1:cid 2:init 3:u1id 4:u1n 5:u1un
+        # 6:u2id 7:u2n 8:u2un 9:u1ok 10:u2ok 11:msgid
+        p = dict(id=row[0], cid=row[1], init=row[2],
+                 u1=row[3], u1n=row[4], u1u=row[5],
+                 u2=row[6], u2n=row[7], u2u=row[8],
+                 ok1=row[9], ok2=row[10])
+
+        if uid == p["u1"]:
+            c.execute("UPDATE pending SET u1_ok=1 WHERE id=?", (pid,))
+            p["ok1"] = 1
+        else:
+            c.execute("UPDATE pending SET u2_ok=1 WHERE id=?", (pid,))
+            p["ok2"] = 1
+
+        if p["ok1"] == 1 and p["ok2"] == 1:
+            # пока предложение ждало, кто-то из двоих успел жениться
+            if any(c.execute(HOT_QUERIES["get_marriage"],
+                             (p["cid"], u, p["cid"], u)).fetchone()
+                   for u in (p["u1"], p["u2"])):
+                c.execute("DELETE FROM pending WHERE id=?", (pid,))
+                return None
+            mid = c.execute(
+                "INSERT INTO marriages"
+                "(chat_id,user1_id,user1_name,user1_un,"
+                "user2_id,user2_name,user2_un,married_at) "
+                "VALUES(?,?,?,?,?,?,?,datetime('now'))",
+                (p["cid"],
+                 p["u1"], p["u1n"], p["u1u"],
+                 p["u2"], p["u2n"], p["u2u"])).lastrowid
+            c.execute("DELETE FROM pending WHERE id=?", (pid,))
+            # в топ пар — с уже записанными сообщениями обоих
+            top_put(c, p["cid"], "c", 0, {mid: (
+                _one(c, "msg_cnt", (p["u1"], p["cid"]))
+                + _one(c, "msg_cnt", (p["u2"], p["cid"])))})
+            _tops.pop((p["cid"], "c", 0), None)
+    return p
+
+
+def reject_pending(cid: int, pid: int) -> Optional[tuple]:
+    with shard(cid).write() as c:
+        row = c.execute(_PENDING_LIVE_SQL, (pid, PENDING_TTL)).fetchone()
+        if row:
+            c.execute("DELETE FROM pending WHERE id=?", (pid,))
+    return row
+
+
+def divorce(cid: int, mid: int) -> Optional[tuple]:
+    with shard(cid).write() as c:
+        row = c.execute(
+            "SELECT * FROM marriages WHERE id=?", (mid,)
+        ).fetchone()
+        if row:
+            c.execute("DELETE FROM marriages WHERE id=?", (mid,))
+            # кто следующий за выбывшей парой, неизвестно — топ чата заново
+            _tops.pop((cid, "c", 0), None)
+            if c.execute("DELETE FROM top WHERE chat_id=? AND board='c' "
+                         "AND bucket=0 AND id=?", (cid, mid)).rowcount:
+                c.execute("DELETE FROM top WHERE chat_id=? AND board='c'",
+                          (cid,))
+                c.execute(_TOP_COUPLES_REBUILD_SQL, (cid, TOP_SIZE))
+    if row:
+        # media_cache в общем файле; id не переиспользуются, так что
+        # оставшаяся при сбое запись просто никогда не будет прочитана
+        with db.write() as c:
+            c.execute("DELETE FROM media_cache WHERE key=?",
+                      (card_key(cid, mid),))
+    return row
+
+
+def card_key(cid: int, mid: int) -> str:
+    return f"card:{cid}:{mid}"
+
+
+def media_get(key: str) -> Optional[tuple]:
+    with db.read() as c:
+        return c.execute(
+            "SELECT sig, file_id FROM media_cache WHERE key=?", (key,)
+        ).fetchone()
+
+
+def media_put(key: str, sig: str, file_id: str):
+    with db.write() as c:
+        c.execute("INSERT OR REPLACE INTO media_cache VALUES(?,?,?)",
+                  (key, sig, file_id))
+
+
 def inc_msg(uid: int, cid: int):
-    with _db() as c:
-        c.execute(
-            "INSERT INTO msg_cnt VALUES(?,?,1) "
-            "ON CONFLICT DO UPDATE SET cnt=cnt+1", (uid, cid)
-        )
+    wb.add_msg(uid, cid)
 
 
 def msg_cnt(uid: int, cid: int) -> int:
-    with _db() as c:
-        r = c.execute(
-            "SELECT cnt FROM msg_cnt WHERE user_id=? AND chat_id=?",
-            (uid, cid),
-        ).fetchone()
+    def query():
+        with shard(cid).read() as c:
+            return c.execute(HOT_QUERIES["msg_cnt"], (uid, cid)).fetchone()
+    return wb.read(query, lambda r: (r[0] if r else 0)
+                   + wb.cnt_delta(uid, cid))
+
+
+def day_of(ts: Optional[float] = None) -> int:
+    """Номер суток с 1970-01-01 по времени UTC + DAY_OFFSET."""
+    return int(((time.time() if ts is None else ts) + DAY_OFFSET) // 86400)
+
+
+def week_of(day: int) -> int:
+    # 1970-01-01 — четверг, а недели начинаются с понедельника
+    return (day + 3) // 7
+
+
+# (cid, board, bucket) -> {id: итог}: топы чатов этого процесса, точная
+# копия БД с итогами. Итоги только растут и все проходят через сброс,
+# поэтому в топ может попасть лишь тот, чей счётчик сейчас изменился, а
+# в БД пишется только смена состава. Чат обрабатывает один процесс;
+# копия меняется сразу после commit под замком писателя шарда, а свадьба
+# и развод под тем же замком её просто выкидывают
+_tops = {}
+TOP_CACHE = 50_000
+
+_ADD_SQL = ("INSERT INTO {} VALUES({}) "
+            "ON CONFLICT DO UPDATE SET cnt=cnt+excluded.cnt RETURNING cnt")
+_ADD_CNT, _ADD_DAILY, _ADD_WEEKLY = (
+    _ADD_SQL.format(t, cols) for t, cols in (
+        ("msg_cnt", "?,?,?"), ("msg_daily", "?,?,?,?"),
+        ("msg_weekly", "?,?,?,?")))
+
+
+def add_messages(c: sqlite3.Connection, cnt: list, days: list) -> dict:
+    """Дельты ((uid, cid), n) и ((uid, cid, сутки), n) — в msg_cnt,
+    msg_daily, msg_weekly и состав топов /top.
+
+    Вернуть изменённые топы — в _tops их кладут после commit.
+    """
+    offers = {}     # (cid, board, bucket) -> {id: итог}
+    # upsert сразу отдаёт новый итог — отдельный SELECT не нужен
+    totals = {}
+    for (uid, cid), n in cnt:
+        total = totals[uid, cid] = c.execute(
+            _ADD_CNT, (uid, cid, n)).fetchone()[0]
+        offers.setdefault((cid, "a", 0), {})[uid] = total
+    weeks = {}
+    for (uid, cid, day), n in days:
+        offers.setdefault((cid, "d", day), {})[uid] = c.execute(
+            _ADD_DAILY, (cid, day, uid, n)).fetchone()[0]
+        k = (uid, cid, week_of(day))
+        weeks[k] = weeks.get(k, 0) + n
+    for (uid, cid, week), n in weeks.items():
+        offers.setdefault((cid, "w", week), {})[uid] = c.execute(
+            _ADD_WEEKLY, (cid, week, uid, n)).fetchone()[0]
+    for (uid, cid), total in totals.items():
+        m = c.execute(HOT_QUERIES["get_marriage"],
+                      (cid, uid, cid, uid)).fetchone()
+        if m:
+            other = m[5] if m[2] == uid else m[2]
+            offers.setdefault((cid, "c", 0), {})[m[0]] = total + (
+                totals.get((other, cid))
+                or _one(c, "msg_cnt", (other, cid)))
+
+    boards, add, gone = {}, [], []
+    for key, scores in offers.items():
+        top = _tops.get(key)
+        top = dict(top) if top is not None else _top_load(c, *key)
+        came, left = _top_merge(top, scores)
+        add += [(*key, i) for i in came]
+        gone += [(*key, i) for i in left]
+        boards[key] = top
+    # одной пачкой на весь сброс; чаще всего обе пустые
+    c.executemany("DELETE FROM top WHERE chat_id=? AND board=? "
+                  "AND bucket=? AND id=?", gone)
+    c.executemany("INSERT INTO top VALUES(?,?,?,?)", add)
+    return boards
+
+
+def rebuild_tops(c: sqlite3.Connection):
+    for sql in _TOPS_REBUILD_SQL:
+        c.execute(sql, {"k": TOP_SIZE} if ":k" in sql else {})
+    _tops.clear()
+
+
+def _one(c: sqlite3.Connection, query: str, args: tuple) -> int:
+    r = c.execute(HOT_QUERIES[query], args).fetchone()
     return r[0] if r else 0
 
 
+def _top_load(c: sqlite3.Connection, cid: int, board: str,
+              bucket: int) -> dict:
+    return {r[0]: r[1] for r in
+            c.execute(HOT_QUERIES["top_" + board], (cid, bucket))}
+
+
+def _top_merge(top: dict, scores: dict) -> tuple:
+    """Влить итоги {id: n} в топ на месте -> (вошли, выбыли)."""
+    came, left = [], []
+    for i, n in scores.items():
+        if i in top:
+            top[i] = n
+        elif len(top) < TOP_SIZE:
+            top[i] = n
+            came.append(i)
+        else:
+            low = min(top, key=top.get)
+            if n > top[low]:
+                del top[low]
+                top[i] = n
+                if low in came:
+                    came.remove(low)
+                else:
+                    left.append(low)
+                came.append(i)
+    return came, left
+
+
+def top_put(c: sqlite3.Connection, cid: int, board: str, bucket: int,
+            scores: dict):
+    """Влить итоги в топ прямо в БД, мимо _tops."""
+    came, left = _top_merge(_top_load(c, cid, board, bucket), scores)
+    c.executemany("DELETE FROM top WHERE chat_id=? AND board=? "
+                  "AND bucket=? AND id=?",
+                  [(cid, board, bucket, i) for i in left])
+    c.executemany("INSERT INTO top VALUES(?,?,?,?)",
+                  [(cid, board, bucket, i) for i in came])
+
+
+def expire_rollups(limit: int) -> int:
+    """Удалить до limit строк активности и топов старше срока хранения."""
+    day = day_of()
+    week = week_of(day)
+    jobs = (("expire_daily", (day - ROLLUP_DAYS,)),
+            ("expire_weekly", (week - ROLLUP_WEEKS,)),
+            ("expire_top", ("d", day - ROLLUP_DAYS)),
+            ("expire_top", ("w", week - ROLLUP_WEEKS)))
+    i, k = _owner
+    n = 0
+    for s in owned_shards():
+        for query, args in jobs:
+            if n >= limit:
+                return n
+            with s.write() as c:
+                n += c.execute(HOT_QUERIES[query],
+                               (*args, k, i, limit - n)).rowcount
+    return n
+
+
+def top_rows(cid: int, board: str, bucket: int) -> list:
+    """Строки топа по местам: (id, сообщений, ...), у пар ещё и имена."""
+    with shard(cid).read() as c:
+        rows = c.execute(HOT_QUERIES["top_" + board], (cid, bucket))
+        return sorted(rows, key=lambda r: r[1], reverse=True)
+
+
+def user_rows(uids: list) -> dict:
+    """uid -> строка known_users для тех, кого удалось найти."""
+    out, miss = {}, []
+    with wb.lock:
+        for uid in uids:
+            r = user_cache.get(uid) or wb.user(uid)
+            if r:
+                out[uid] = r
+            else:
+                miss.append(uid)
+    if miss:
+        def query():
+            with db.read() as c:
+                return c.execute(
+                    "SELECT user_id,username,first_name,last_name "
+                    "FROM known_users WHERE user_id IN "
+                    f"({','.join('?' * len(miss))})", miss).fetchall()
+
+        def merge(rows):
+            # пока читали БД, профиль мог обновиться в буфере
+            for r in rows:
+                out[r[0]] = wb.user(r[0]) or r
+        wb.read(query, merge)
+    return out
+
+
 def mn(name, un):
     """mention helper"""
     return f"@{un}" if un else name
@@ -184,39 +1554,83 @@ def parse_dt(s):
 # ══════════════════════════════════════════════════════════
 #  ГЕНЕРАЦИЯ КАРТИНКИ
 # ══════════════════════════════════════════════════════════
+# Pillow нужен только для /couple: модули импортируются при первом
+# обращении, до тех пор вместо них заглушки _Lazy.
+
+class _Lazy:
+    """Заглушка модуля: первое обращение к атрибуту импортирует модуль
+    и подменяет им глобальное имя, дальше всё идёт мимо заглушки."""
+
+    def __init__(self, alias: str, module: str):
+        self._alias, self._module = alias, module
+
+    def __getattr__(self, attr):
+        t = time.perf_counter()
+        mod = importlib.import_module(self._module)
+        if globals().get(self._alias) is self:
+            globals()[self._alias] = mod
+            log.info("импорт %s: %.0f мс", self._module,
+                     (time.perf_counter() - t) * 1000)
+        return getattr(mod, attr)
+
+
+Image = _Lazy("Image", "PIL.Image")
+ImageDraw = _Lazy("ImageDraw", "PIL.ImageDraw")
+ImageFont = _Lazy("ImageFont", "PIL.ImageFont")
+
+_FONT_PATHS = (
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/truetype/freefont/FreeSansBold.ttf",
+    "C:/Windows/Fonts/arialbd.ttf",
+    "C:/Windows/Fonts/arial.ttf",
+    "/System/Library/Fonts/Helvetica.ttc",
+)
+
+
+@lru_cache(maxsize=1)
+def _font_path() -> Optional[str]:
+    """Первый существующий файл из _FONT_PATHS; ищется один раз."""
+    path = next((p for p in _FONT_PATHS if os.path.isfile(p)), None)
+    log.info("шрифт карточек: %s", path or "встроенный")
+    return path
 
+
+@lru_cache(maxsize=None)
 def _font(sz):
-    paths = [
-        "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
-        "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
-        "/usr/share/fonts/truetype/freefont/FreeSansBold.ttf",
-        "C:/Windows/Fonts/arialbd.ttf",
-        "C:/Windows/Fonts/arial.ttf",
-        "/System/Library/Fonts/Helvetica.ttc",
-    ]
-    for p in paths:
+    """Шрифт размера sz; объект на каждый размер создаётся один раз."""
+    path = _font_path()
+    if path:
         try:
-            return ImageFont.truetype(p, sz)
+            return ImageFont.truetype(path, sz)
         except OSError:
-            continue
+            log.warning("шрифт %s не открылся, беру встроенный", path)
     try:
         return ImageFont.load_default(sz)
     except TypeError:
         return ImageFont.load_default()
 
 
-async def _avatar(bot, uid) -> Optional[Image.Image]:
+async def _avatar(bot, file_id) -> Optional[bytes]:
     try:
-        ph = await bot.get_user_profile_photos(uid, limit=1)
-        if not ph.photos:
-            return None
-        f = await bot.get_file(ph.photos[0][-1].file_id)
-        ba = await f.download_as_bytearray()
-        return Image.open(io.BytesIO(ba)).convert("RGBA")
+        f = await bot.get_file(file_id)
+        return bytes(await f.download_as_bytearray())
     except Exception:
         return None
 
 
+# раскладка карточки /couple
+CARD_W, CARD_H = 900, 500
+AV_SZ = 150                  # диаметр аватарки
+AV_FRAME = AV_SZ + 10        # сторона кружка вместе с белой рамкой
+AV_GAP = 90                  # между рамками аватарок
+AV_Y = 30
+AV_X1 = CARD_W // 2 - AV_SZ - AV_GAP // 2
+AV_X2 = CARD_W // 2 + AV_GAP // 2
+LINE_Y = AV_Y + AV_SZ + 58
+
+
+@lru_cache(maxsize=None)
 def _placeholder(sz):
     img = Image.new("RGBA", (sz, sz), (180, 170, 210, 255))
     d = ImageDraw.Draw(img)
@@ -228,42 +1642,90 @@ def _placeholder(sz):
     return img
 
 
-def _crop_circle(img, sz):
-    img = img.resize((sz, sz), Image.LANCZOS)
+@lru_cache(maxsize=None)
+def _circle_mask(sz):
     mask = Image.new("L", (sz, sz), 0)
     ImageDraw.Draw(mask).ellipse((0, 0, sz, sz), fill=255)
-    out = Image.new("RGBA", (sz, sz), (0, 0, 0, 0))
-    out.paste(img, mask=mask)
+    return mask
+
+
+@lru_cache(maxsize=None)
+def _frame(sz):
     bsz = sz + 10
     frm = Image.new("RGBA", (bsz, bsz), (0, 0, 0, 0))
     ImageDraw.Draw(frm).ellipse((0, 0, bsz-1, bsz-1), fill="white")
+    return frm
+
+
+@lru_cache(maxsize=None)
+def _placeholder_circle(sz):
+    return _crop_circle(_placeholder(sz), sz)
+
+
+def _crop_circle(img, sz):
+    img = img.resize((sz, sz), Image.LANCZOS)
+    out = Image.new("RGBA", (sz, sz), (0, 0, 0, 0))
+    out.paste(img, mask=_circle_mask(sz))
+    frm = _frame(sz).copy()
     frm.paste(out, (5, 5), out)
     return frm
 
 
-def _heart(draw, cx, cy, size, color=(255, 70, 80)):
+@lru_cache(maxsize=None)
+def _heart_unit() -> tuple:
+    """Контур сердца при size=1 с центром в (0, 0); считается один раз."""
     pts = []
     for deg in range(360):
         t = math.radians(deg)
         x = 16 * math.sin(t) ** 3
         y = -(13*math.cos(t) - 5*math.cos(2*t) -
               2*math.cos(3*t) - math.cos(4*t))
-        pts.append((cx + x * size / 17, cy + y * size / 17))
-    draw.polygon(pts, fill=color)
-
-
-def build_card(av1, av2, n1, n2, days, msgs, wdate) -> io.BytesIO:
-    W, H = 900, 500
-    img = Image.new("RGBA", (W, H))
-    d = ImageDraw.Draw(img)
-
-    # градиент розовый → фиолетовый
-    for y in range(H):
-        t = y / H
-        r = int(210*(1-t) + 75*t)
-        g = int(130*(1-t) + 35*t)
-        b = int(210*(1-t) + 175*t)
-        d.line([(0, y), (W, y)], fill=(r, g, b))
+        pts.append((x / 17, y / 17))
+    return tuple(pts)
+
+
+# декоративные фигуры: имя -> единичный контур; рисовать только через stamp()
+SHAPES = {
+    "heart": _heart_unit,
+}
+SPRITE_SS = 4    # во сколько раз крупнее рисуем спрайт перед уменьшением
+
+
+@lru_cache(maxsize=256)
+def sprite(shape: str, size: int, color: tuple) -> tuple:
+    """Сглаженный RGBA-спрайт фигуры и смещение его угла от центра."""
+    pts = SHAPES[shape]()
+    ox = math.floor(min(x for x, _ in pts) * size) - 1
+    oy = math.floor(min(y for _, y in pts) * size) - 1
+    w = math.ceil(max(x for x, _ in pts) * size) + 1 - ox
+    h = math.ceil(max(y for _, y in pts) * size) + 1 - oy
+    k = SPRITE_SS
+    mask = Image.new("L", (w * k, h * k), 0)
+    ImageDraw.Draw(mask).polygon(
+        [((x * size - ox) * k, (y * size - oy) * k) for x, y in pts],
+        fill=255)
+    spr = Image.new("RGBA", (w, h), (*color, 255))
+    spr.putalpha(mask.resize((w, h), Image.BOX))
+    return spr, ox, oy
+
+
+def stamp(img, shape, cx, cy, size, color=(255, 70, 80)):
+    """Положить спрайт фигуры центром в (cx, cy)."""
+    spr, ox, oy = sprite(shape, size, color)
+    img.alpha_composite(spr, (cx + ox, cy + oy))
+
+
+@lru_cache(maxsize=1)
+def _card_base() -> "Image.Image":
+    """Всё статичное в карточке; рисуется один раз, дальше только .copy()."""
+    # градиент розовый → фиолетовый: столбец 1×H растягиваем по ширине
+    col = Image.new("RGBA", (1, CARD_H))
+    col.putdata([
+        (int(210*(1-t) + 75*t), int(130*(1-t) + 35*t),
+         int(210*(1-t) + 175*t), 255)
+        for t in (y / CARD_H for y in range(CARD_H))
+    ])
+    img = col.resize((CARD_W, CARD_H), Image.NEAREST)
 
     # декоративные сердечки
     for hx, hy, hs in [
@@ -271,22 +1733,48 @@ def build_card(av1, av2, n1, n2, days, msgs, wdate) -> io.BytesIO:
         (820, 410, 6), (450, 15, 6), (750, 240, 5),
         (150, 250, 5),
     ]:
-        _heart(d, hx, hy, hs, (255, 220, 230))
-
-    # аватарки
-    SZ = 150
-    a1 = _crop_circle(av1 if av1 else _placeholder(SZ), SZ)
-    a2 = _crop_circle(av2 if av2 else _placeholder(SZ), SZ)
-    gap = 90
-    x1 = W // 2 - SZ - gap // 2
-    x2 = W // 2 + gap // 2
-    AY = 30
-    img.paste(a1, (x1, AY), a1)
-    img.paste(a2, (x2, AY), a2)
-    d = ImageDraw.Draw(img)
+        stamp(img, "heart", hx, hy, hs, (255, 220, 230))
 
     # сердце между аватарками
-    _heart(d, W // 2, AY + SZ // 2 + 5, 16, (255, 80, 90))
+    stamp(img, "heart", CARD_W // 2, AV_Y + AV_SZ // 2 + 5, 16,
+          (255, 80, 90))
+
+    # линия
+    d = ImageDraw.Draw(img)
+    d.line([(CARD_W//4, LINE_Y), (3*CARD_W//4, LINE_Y)],
+           fill=(255, 255, 255), width=2)
+    return img
+
+
+def compose_card(av1, av2, n1, n2, days, msgs, wdate,
+                 stages: Optional[dict] = None) -> "Image.Image":
+    """av1/av2 — готовые кружки из _crop_circle или None.
+
+    Если передан stages — туда пишутся секунды по этапам.
+    """
+    t0 = time.perf_counter()
+    img = _card_base().copy()
+    t1 = time.perf_counter()
+    paste_avatars(img, av1, av2)
+    t2 = time.perf_counter()
+    draw_texts(img, n1, n2, days, msgs, wdate)
+    if stages is not None:
+        stages.update(background=t1 - t0, avatars=t2 - t1,
+                      text=time.perf_counter() - t2)
+    return img
+
+
+def paste_avatars(img, av1, av2):
+    a1 = av1 or _placeholder_circle(AV_SZ)
+    a2 = av2 or _placeholder_circle(AV_SZ)
+    img.paste(a1, (AV_X1, AV_Y), a1)
+    img.paste(a2, (AV_X2, AV_Y), a2)
+
+
+def draw_texts(img, n1, n2, days, msgs, wdate):
+    W, SZ = CARD_W, AV_SZ
+    x1, x2, AY = AV_X1, AV_X2, AV_Y
+    d = ImageDraw.Draw(img)
 
     # имена
     fn = _font(22)
@@ -296,10 +1784,6 @@ def build_card(av1, av2, n1, n2, days, msgs, wdate) -> io.BytesIO:
         nx = ax + (SZ + 10) // 2 - tw // 2
         d.text((nx, AY + SZ + 18), name, fill="white", font=fn)
 
-    # линия
-    LY = AY + SZ + 58
-    d.line([(W//4, LY), (3*W//4, LY)], fill=(255, 255, 255), width=2)
-
     # статистика
     bf = _font(28)
     sf = _font(22)
@@ -308,16 +1792,472 @@ def build_card(av1, av2, n1, n2, days, msgs, wdate) -> io.BytesIO:
         (f"Сообщений вместе: {msgs}", bf),
         (f"Дата свадьбы: {wdate}", sf),
     ]
-    sy = LY + 25
+    sy = LINE_Y + 25
     for txt, fnt in lines:
         bb = d.textbbox((0, 0), txt, font=fnt)
         d.text(((W - bb[2] + bb[0]) // 2, sy), txt, fill="white", font=fnt)
         sy += 52
 
+
+def _encode(img, fmt, quality) -> bytes:
     buf = io.BytesIO()
-    img.convert("RGB").save(buf, "PNG")
-    buf.seek(0)
-    return buf
+    if fmt == "jpeg":
+        img.save(buf, "JPEG", quality=quality,
+                 subsampling=CARD_JPEG_SUBSAMPLING, optimize=True)
+    elif fmt == "webp":
+        img.save(buf, "WEBP", quality=quality, method=CARD_WEBP_METHOD)
+    else:
+        img.save(buf, "PNG", compress_level=quality)
+    return buf.getvalue()
+
+
+def encode_card(img) -> tuple:
+    """Карточка в CARD_FORMAT с учётом CARD_MAX_BYTES -> (байты, статистика).
+
+    PNG при превышении бюджета дожимается до compress_level=9, затем
+    уходит в JPEG; JPEG/WebP снижают качество шагами по 10.
+    """
+    t = time.perf_counter()
+    img = img.convert("RGB")
+    fmt = CARD_FORMAT if CARD_FORMAT in ("jpeg", "webp") else "png"
+    q = CARD_PNG_LEVEL if fmt == "png" else CARD_QUALITY
+    data = _encode(img, fmt, q)
+    while CARD_MAX_BYTES and len(data) > CARD_MAX_BYTES:
+        if fmt == "png":
+            if q < 9:
+                q = 9
+            else:
+                fmt, q = "jpeg", CARD_QUALITY
+        elif q - 10 >= CARD_MIN_QUALITY:
+            q -= 10
+        else:
+            break
+        data = _encode(img, fmt, q)
+    stats = {"format": fmt, "quality": q, "bytes": len(data),
+             "encode_ms": (time.perf_counter() - t) * 1000}
+    return data, stats
+
+
+def warm_render():
+    """Всё, что карточка грузит и рисует один раз (RENDER_PRELOAD)."""
+    _card_base()
+    _placeholder_circle(AV_SZ)
+    _font(22)
+    _font(28)
+
+
+def build_card(av1, av2, n1, n2, days, msgs, wdate) -> io.BytesIO:
+    data, _ = encode_card(compose_card(av1, av2, n1, n2, days, msgs, wdate))
+    return io.BytesIO(data)
+
+
+def prepare_avatar(raw: bytes) -> bytes:
+    """Скачанное фото -> RGBA-байты кружка с рамкой (для пула)."""
+    img = Image.open(io.BytesIO(raw)).convert("RGBA")
+    return _crop_circle(img, AV_SZ).tobytes()
+
+
+def render_card(av1: Optional[bytes], av2: Optional[bytes],
+                n1, n2, days, msgs, wdate) -> tuple:
+    """build_card для пула: байты на входе, (байты, статистика) на выходе.
+
+    В статистике stages — секунды по этапам, для метрик в основном процессе.
+    """
+    a1, a2 = (Image.frombytes("RGBA", (AV_FRAME, AV_FRAME), b) if b else None
+              for b in (av1, av2))
+    stages = {}
+    img = compose_card(a1, a2, n1, n2, days, msgs, wdate, stages)
+    data, st = encode_card(img)
+    stages["encode"] = st["encode_ms"] / 1000
+    st["stages"] = stages
+    return data, st
+
+
+_render_pool = None
+_renders = 0     # карточек в работе и в очереди пула
+
+
+def start_render_pool():
+    global _render_pool
+    if RENDER_MODE == "thread":
+        _render_pool = ThreadPoolExecutor(
+            RENDER_WORKERS, thread_name_prefix="render")
+    else:
+        # spawn: не тащить в воркеры потоки и соединения родителя
+        _render_pool = ProcessPoolExecutor(
+            RENDER_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+
+def render_busy() -> bool:
+    return _renders >= RENDER_QUEUE
+
+
+def _render_done(_):
+    global _renders
+    _renders -= 1
+
+
+def _replace_render_pool(broken):
+    """Пересоздать упавший пул, если его ещё не пересоздал другой вызов."""
+    if _render_pool is broken:
+        log.exception("пул рендера умер, пересоздаю")
+        broken.shutdown(wait=False, cancel_futures=True)
+        start_render_pool()
+
+
+async def in_render_pool(failed: Counter, fn, *args):
+    """fn(*args) в пуле рендера с учётом RENDER_QUEUE и RENDER_TIMEOUT.
+
+    None, если пул перегружен, завис или упал; причина — в failed.
+    """
+    global _renders
+    if render_busy():
+        failed.inc("busy")
+        return None
+    _renders += 1
+    # пул, куда ушло задание: пока ждём, его мог пересоздать другой вызов
+    pool = _render_pool
+    try:
+        fut = asyncio.get_running_loop().run_in_executor(pool, fn, *args)
+    except BrokenProcessPool:
+        _render_done(None)
+        failed.inc("pool")
+        _replace_render_pool(pool)
+        return None
+    # счётчик отпускаем, только когда воркер реально освободился
+    fut.add_done_callback(_render_done)
+    try:
+        return await asyncio.wait_for(asyncio.shield(fut), RENDER_TIMEOUT)
+    except asyncio.TimeoutError:
+        failed.inc("timeout")
+        log.warning("%s: пул не ответил за %s с", fn.__name__,
+                    RENDER_TIMEOUT)
+    except BrokenProcessPool:
+        failed.inc("pool")
+        _replace_render_pool(pool)
+    except Exception:
+        failed.inc("error")
+        log.exception("%s: ошибка в пуле рендера", fn.__name__)
+    return None
+
+
+async def render(*args) -> Optional[bytes]:
+    """PNG карточки или None, если пул перегружен, завис или упал."""
+    with CARD_SECONDS.timer("total"):
+        res = await in_render_pool(CARD_FAILED, render_card, *args)
+    if not res:
+        return None
+    data, st = res
+    for stage, sec in st["stages"].items():
+        CARD_SECONDS.observe(sec, stage)
+    log.info("карточка: %s q=%s, %.1f КБ, кодирование %.1f мс",
+             st["format"], st["quality"], st["bytes"] / 1024,
+             st["encode_ms"])
+    return data
+
+
+_photo_ids = LRU(AVATAR_CACHE_SIZE * 8)  # uid -> (unique_id, file_id, когда)
+_circles = LRU(AVATAR_CACHE_SIZE)        # unique_id -> RGBA-байты кружка
+
+
+async def avatar_id(bot, uid) -> Optional[tuple]:
+    """(file_unique_id, file_id) текущей аватарки; список фото — раз в TTL."""
+    meta = _photo_ids.get(uid)
+    fresh = meta and time.monotonic() - meta[2] <= AVATAR_TTL
+    CACHE.inc("photo_ids", "hit" if fresh else "miss")
+    if not fresh:
+        try:
+            ph = await bot.get_user_profile_photos(uid, limit=1)
+        except Exception:
+            return meta[:2] if meta and meta[0] else None
+        big = ph.photos[0][-1] if ph.photos else None
+        meta = (big.file_unique_id if big else None,
+                big.file_id if big else None, time.monotonic())
+        _photo_ids.put(uid, meta)
+    return meta[:2] if meta[0] else None
+
+
+def _load_circle(path: str) -> bytes:
+    # mtime — время последнего использования, по нему чистит prune_avatars
+    os.utime(path)
+    with Image.open(path) as img:
+        return img.convert("RGBA").tobytes()
+
+
+def _save_circle(path: str, circle: bytes):
+    os.makedirs(AVATAR_DIR, exist_ok=True)
+    tmp = path + ".tmp"
+    Image.frombytes("RGBA", (AV_FRAME, AV_FRAME), circle).save(tmp, "PNG")
+    os.replace(tmp, path)
+
+
+def prune_avatars(keep: int = AVATAR_DISK_MAX) -> int:
+    """Оставить в AVATAR_DIR keep самых свежих кружков, вернуть удалённых."""
+    try:
+        files = [e for e in os.scandir(AVATAR_DIR) if e.is_file()]
+    except FileNotFoundError:
+        return 0
+    if len(files) <= keep:
+        return 0
+    files.sort(key=lambda e: e.stat().st_mtime)
+    n = 0
+    for e in files[:len(files) - keep]:
+        try:
+            os.remove(e.path)
+            n += 1
+        except FileNotFoundError:    # удалил параллельный проход
+            pass
+    return n
+
+
+async def avatar(bot, uid) -> Optional[bytes]:
+    """Кружок аватарки uid: память -> диск -> скачать и подготовить."""
+    ids = await avatar_id(bot, uid)
+    if not ids:
+        return None
+    fuid, file_id = ids
+    circle = _circles.get(fuid)
+    CACHE.inc("avatars", "hit" if circle else "miss")
+    if circle:
+        return circle
+    loop = asyncio.get_running_loop()
+    path = os.path.join(AVATAR_DIR, f"{fuid}.png")
+    try:
+        if os.path.exists(path):
+            with AVATAR_SECONDS.timer("disk"):
+                circle = await loop.run_in_executor(None, _load_circle, path)
+        else:
+            with AVATAR_SECONDS.timer("download"):
+                raw = await _avatar(bot, file_id)
+            if not raw:
+                return None
+            # тот же ограниченный путь, что у карточки: зависший пул не
+            # держит /couple, вместо фото будет заглушка
+            with AVATAR_SECONDS.timer("prepare"):
+                circle = await in_render_pool(
+                    AVATAR_FAILED, prepare_avatar, raw)
+            if not circle:
+                return None
+            await loop.run_in_executor(None, _save_circle, path, circle)
+    except Exception:
+        log.exception("аватарка %s: не удалось подготовить", uid)
+        return None
+    _circles.put(fuid, circle)
+    return circle
+
+# ══════════════════════════════════════════════════════════
+#  ИСХОДЯЩИЕ СООБЩЕНИЯ
+# ══════════════════════════════════════════════════════════
+
+class _Bucket:
+    """Token bucket: rate токенов в секунду, не больше burst про запас."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate, self.burst = rate, burst
+        self.tokens, self.t = burst, time.monotonic()
+
+    def take(self) -> float:
+        """Взять токен; вернуть 0 или сколько секунд подождать."""
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.t) * self.rate)
+        self.t = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def pause(self, seconds: float):
+        """Следующий токен — не раньше чем через seconds секунд."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, 1 - seconds * self.rate,
+                          self.tokens + (now - self.t) * self.rate)
+        self.t = now
+
+
+class _Out:
+    __slots__ = ("call", "futs", "key")
+
+    def __init__(self, call, key=None):
+        self.call, self.key = call, key
+        self.futs = [asyncio.get_running_loop().create_future()]
+
+
+class Outbox:
+    """Очередь исходящих вызовов Bot API с лимитами и учётом 429.
+
+    У каждого чата своя FIFO-очередь и свой token bucket, поверх — общий
+    bucket на бота. RetryAfter выдерживается и вызов повторяется, а общий
+    bucket на это время закрывается: 429 бывает и на весь бот. Правка
+    сообщения, ещё ждущая в очереди, заменяется более новой правкой того
+    же сообщения — уходит только итоговое состояние.
+    """
+
+    def __init__(self):
+        self._global = _Bucket(OUT_RATE, OUT_RATE)
+        self._chat_buckets = LRU(10_000)
+        self._queues = {}    # cid -> deque[_Out]
+        self._workers = {}   # cid -> Task
+        self._edits = {}     # (cid, msg_id) -> _Out, ещё не отправленная
+
+    def _bucket(self, cid) -> _Bucket:
+        b = self._chat_buckets.get(cid)
+        if b is None:
+            b = _Bucket(OUT_CHAT_RATE, OUT_CHAT_BURST)
+            self._chat_buckets.put(cid, b)
+        return b
+
+    def _push(self, cid, out: _Out):
+        self._queues.setdefault(cid, deque()).append(out)
+        if cid not in self._workers:
+            self._workers[cid] = asyncio.create_task(self._run(cid))
+
+    def send(self, cid, call) -> asyncio.Future:
+        """call() -> корутина вызова API; результат придёт в future."""
+        out = _Out(call)
+        self._push(cid, out)
+        return out.futs[0]
+
+    def edit(self, cid, msg_id, call) -> asyncio.Future:
+        key = (cid, msg_id)
+        out = self._edits.get(key)
+        if out:
+            # ещё не ушла — отправим сразу итоговый вариант
+            out.call = call
+            fut = asyncio.get_running_loop().create_future()
+            out.futs.append(fut)
+        else:
+            out = self._edits[key] = _Out(call, key)
+            self._push(cid, out)
+            fut = out.futs[0]
+        fut.add_done_callback(_log_edit)
+        return fut
+
+    async def _wait(self, bucket: _Bucket):
+        while delay := bucket.take():
+            await asyncio.sleep(delay)
+
+    async def _call(self, call):
+        for attempt in range(OUT_RETRIES):
+            try:
+                return await call()
+            except RetryAfter as e:
+                OUT_429.inc()
+                ra = e.retry_after
+                ra = ra.total_seconds() if hasattr(ra, "total_seconds") else ra
+                log.warning("429 от Telegram, ждём %s с", ra)
+                # остальные чаты тоже не шлют, пока лимит не отпустит
+                self._global.pause(ra)
+                if attempt == OUT_RETRIES - 1:
+                    raise
+                await asyncio.sleep(ra)
+
+    async def _run(self, cid):
+        q = self._queues[cid]
+        try:
+            while q:
+                out = q[0]
+                await self._wait(self._bucket(cid))
+                await self._wait(self._global)
+                q.popleft()
+                if out.key:
+                    self._edits.pop(out.key, None)
+                try:
+                    res = await self._call(out.call)
+                except Exception as e:
+                    for f in out.futs:
+                        if not f.done():
+                            f.set_exception(e)
+                else:
+                    for f in out.futs:
+                        if not f.done():
+                            f.set_result(res)
+        finally:
+            del self._queues[cid]
+            del self._workers[cid]
+
+    def share(self, k: int):
+        """Один из k процессов бота: общий лимит делим поровну."""
+        self._global = _Bucket(OUT_RATE / k, OUT_RATE / k)
+
+    async def drain(self, timeout: float):
+        if self._workers:
+            await asyncio.wait(list(self._workers.values()), timeout=timeout)
+
+
+def _log_edit(fut):
+    if fut.cancelled() or not fut.exception():
+        return
+    e = fut.exception()
+    if isinstance(e, BadRequest) and "not modified" in str(e):
+        return
+    log.warning("правка сообщения не ушла: %s", e)
+
+
+outbox = Outbox()
+
+
+async def reply(m, text, **kw):
+    return await outbox.send(m.chat_id, partial(m.reply_text, text, **kw))
+
+
+async def reply_photo(m, photo, **kw):
+    return await outbox.send(m.chat_id, partial(m.reply_photo, photo, **kw))
+
+
+def edit(q, text, **kw):
+    """Правка сообщения с кнопкой; не ждём — правки одного сообщения
+    схлопываются, пока стоят в очереди."""
+    m = q.message
+    outbox.edit(m.chat_id, m.message_id,
+                partial(q.edit_message_text, text, **kw))
+
+# ══════════════════════════════════════════════════════════
+#  КЕШ FILE_ID
+# ══════════════════════════════════════════════════════════
+
+# key -> (sig, file_id); один раз загруженное шлём по file_id
+_media = LRU(1024)
+
+
+async def cached_file_id(key: str, sig: str) -> Optional[str]:
+    hit = _media.get(key)
+    if hit is None:
+        hit = await run_db(media_get, key) or ("", "")
+        _media.put(key, hit)
+    CACHE.inc("file_id", "hit" if hit[0] == sig else "miss")
+    return hit[1] if hit[0] == sig else None
+
+
+async def remember_file_id(key: str, sig: str, sent):
+    if not sent or not sent.photo:
+        return
+    fid = sent.photo[-1].file_id
+    _media.put(key, (sig, fid))
+    await run_db(media_put, key, sig, fid)
+
+
+async def reply_cached_photo(m, key: str, sig: str, **kw) -> bool:
+    """Ответить фото по закешированному file_id; False — если нечем."""
+    fid = await cached_file_id(key, sig)
+    if not fid:
+        return False
+    try:
+        await reply_photo(m, fid, **kw)
+        return True
+    except BadRequest:
+        log.warning("file_id для %s больше не работает", key)
+        _media.pop(key, None)
+        return False
+
+
+@lru_cache(maxsize=1)
+def _start_sig() -> Optional[str]:
+    try:
+        st = os.stat(START_IMAGE)
+    except OSError:
+        return None
+    return f"{st.st_mtime_ns}:{st.st_size}"
 
 # ══════════════════════════════════════════════════════════
 #  /start
@@ -325,7 +2265,6 @@ def build_card(av1, av2, n1, n2, days, msgs, wdate) -> io.BytesIO:
 
 async def cmd_start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     cache_user(update.effective_user)
-    me = await ctx.bot.get_me()
     text = (
         "💍 <b>Свадебный бот</b> 💍\n\n"
         "Привет! Я помогу заключить браки\n"
@@ -337,15 +2276,24 @@ async def cmd_start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     kb = InlineKeyboardMarkup([
         [InlineKeyboardButton(
             "➕ Добавить в группу",
-            url=f"https://t.me/{me.username}?startgroup=true")],
+            # username бота получен один раз в Application.initialize()
+            url=f"https://t.me/{ctx.bot.username}?startgroup=true")],
         [InlineKeyboardButton("📜 Команды", callback_data="cmds")],
     ])
-    if os.path.exists(START_IMAGE):
+    sig = _start_sig()
+    if sig and await reply_cached_photo(
+            update.message, "start", sig,
+            caption=text, parse_mode="HTML", reply_markup=kb):
+        return
+    if sig:
+        # байты, а не файл: при повторе после 429 отправятся заново
         with open(START_IMAGE, "rb") as f:
-            await update.message.reply_photo(
-                f, caption=text, parse_mode="HTML", reply_markup=kb)
+            photo = f.read()
+        sent = await reply_photo(update.message,
+            photo, caption=text, parse_mode="HTML", reply_markup=kb)
+        await remember_file_id("start", sig, sent)
     else:
-        await update.message.reply_text(
+        await reply(update.message,
             text, parse_mode="HTML", reply_markup=kb)
 
 # ══════════════════════════════════════════════════════════
@@ -358,9 +2306,9 @@ async def cmd_tomarry(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     cid = update.effective_chat.id
 
     if update.effective_chat.type == "private":
-        return await m.reply_text("❌ Эта команда только для групп!")
+        return await reply(m, "❌ Эта команда только для групп!")
     if len(ctx.args) < 2:
-        return await m.reply_text(
+        return await reply(m,
             "❌ Формат: <code>/tomarry @ник1 @ник2</code>",
             parse_mode="HTML")
 
@@ -368,38 +2316,31 @@ async def cmd_tomarry(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     un2 = ctx.args[1].lstrip("@")
 
     if un1.lower() == un2.lower():
-        return await m.reply_text(
+        return await reply(m,
             "❌ Нельзя женить человека на самом себе 😅")
 
-    u1, u2 = find_user(un1), find_user(un2)
+    u1 = await run_db(find_user, un1)
+    u2 = await run_db(find_user, un2)
     if not u1:
-        return await m.reply_text(
+        return await reply(m,
             f"❌ @{un1} не найден.\n"
             "Пусть напишет хотя бы одно сообщение в чат.")
     if not u2:
-        return await m.reply_text(
+        return await reply(m,
             f"❌ @{un2} не найден.\n"
             "Пусть напишет хотя бы одно сообщение в чат.")
-    if get_marriage(u1["id"], cid):
-        return await m.reply_text(
+    if await run_db(get_marriage, u1["id"], cid):
+        return await reply(m,
             f"❌ {mn(u1['name'], u1['un'])} уже в браке!")
-    if get_marriage(u2["id"], cid):
-        return await m.reply_text(
+    if await run_db(get_marriage, u2["id"], cid):
+        return await reply(m,
             f"❌ {mn(u2['name'], u2['un'])} уже в браке!")
-    if pending_for(u1["id"], cid) or pending_for(u2["id"], cid):
-        return await m.reply_text(
+    if (await run_db(pending_for, u1["id"], cid)
+            or await run_db(pending_for, u2["id"], cid)):
+        return await reply(m,
             "❌ Уже есть активное предложение для одного из них!")
 
-    with _db() as c:
-        cur = c.execute(
-            "INSERT INTO pending"
-            "(chat_id,initiator_id,u1_id,u1_name,u1_un,"
-            "u2_id,u2_name,u2_un,u1_ok,u2_ok,created_at) "
-            "VALUES(?,?,?,?,?,?,?,?,NULL,NULL,datetime('now'))",
-            (cid, update.effective_user.id,
-             u1["id"], u1["name"], u1["un"],
-             u2["id"], u2["name"], u2["un"]))
-        pid = cur.lastrowid
+    pid = await run_db(create_pending, cid, update.effective_user.id, u1, u2)
 
     kb = InlineKeyboardMarkup([
         [InlineKeyboardButton(
@@ -416,15 +2357,13 @@ async def cmd_tomarry(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
              callback_data=f"no_{pid}_{u2['id']}")],
     ])
 
-    sent = await m.reply_text(
+    sent = await reply(m,
         f"💒 <b>{update.effective_user.first_name}</b> хочет поженить "
         f"<b>{u1['name']}</b> и <b>{u2['name']}</b>!\n\n"
         f"Оба должны дать согласие! 💍",
         parse_mode="HTML", reply_markup=kb)
 
-    with _db() as c:
-        c.execute("UPDATE pending SET msg_id=? WHERE id=?",
-                  (sent.message_id, pid))
+    await run_db(set_pending_msg, cid, pid, sent.message_id)
 
 # ══════════════════════════════════════════════════════════
 #  /marry @user
@@ -437,39 +2376,34 @@ async def cmd_marry(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     me = update.effective_user
 
     if update.effective_chat.type == "private":
-        return await m.reply_text("❌ Эта команда только для групп!")
+        return await reply(m, "❌ Эта команда только для групп!")
     if len(ctx.args) < 1:
-        return await m.reply_text(
+        return await reply(m,
             "❌ Формат: <code>/marry @ник</code>", parse_mode="HTML")
 
     tun = ctx.args[0].lstrip("@")
 
     if tun.lower() == (me.username or "").lower():
-        return await m.reply_text("❌ Нельзя жениться на себе 😅")
+        return await reply(m, "❌ Нельзя жениться на себе 😅")
 
-    target = find_user(tun)
+    target = await run_db(find_user, tun)
     if not target:
-        return await m.reply_text(
+        return await reply(m,
             f"❌ @{tun} не найден.\n"
             "Пусть напишет хотя бы одно сообщение в чат.")
-    if get_marriage(me.id, cid):
-        return await m.reply_text("❌ Ты уже в браке!")
-    if get_marriage(target["id"], cid):
-        return await m.reply_text(
+    if await run_db(get_marriage, me.id, cid):
+        return await reply(m, "❌ Ты уже в браке!")
+    if await run_db(get_marriage, target["id"], cid):
+        return await reply(m,
             f"❌ {mn(target['name'], target['un'])} уже в браке!")
-    if pending_for(me.id, cid) or pending_for(target["id"], cid):
-        return await m.reply_text("❌ Уже есть активное предложение!")
+    if (await run_db(pending_for, me.id, cid)
+            or await run_db(pending_for, target["id"], cid)):
+        return await reply(m, "❌ Уже есть активное предложение!")
 
-    with _db() as c:
-        cur = c.execute(
-            "INSERT INTO pending"
-            "(chat_id,initiator_id,u1_id,u1_name,u1_un,"
-            "u2_id,u2_name,u2_un,u1_ok,u2_ok,created_at) "
-            "VALUES(?,?,?,?,?,?,?,?,1,NULL,datetime('now'))",
-            (cid, me.id,
-             me.id, me.first_name, me.username or "",
-             target["id"], target["name"], target["un"]))
-        pid = cur.lastrowid
+    pid = await run_db(
+        create_pending, cid, me.id,
+        {"id": me.id, "name": me.first_name, "un": me.username or ""},
+        target, 1)
 
     kb = InlineKeyboardMarkup([[
         InlineKeyboardButton(
@@ -481,15 +2415,13 @@ async def cmd_marry(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     ]])
 
     tmn = mn(target["name"], target["un"])
-    sent = await m.reply_text(
+    sent = await reply(m,
         f"💍 <b>{me.first_name}</b> предлагает руку и сердце "
         f"<b>{target['name']}</b>!\n\n"
         f"{tmn}, ты согласен(на)? 💒",
         parse_mode="HTML", reply_markup=kb)
 
-    with _db() as c:
-        c.execute("UPDATE pending SET msg_id=? WHERE id=?",
-                  (sent.message_id, pid))
+    await run_db(set_pending_msg, cid, pid, sent.message_id)
 
 # ══════════════════════════════════════════════════════════
 #  /marriages
@@ -498,27 +2430,62 @@ async def cmd_marry(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 async def cmd_marriages(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     cache_user(update.effective_user)
     if update.effective_chat.type == "private":
-        return await update.message.reply_text(
+        return await reply(update.message,
             "❌ Эта команда только для групп!")
 
-    with _db() as c:
-        rows = c.execute(
-            "SELECT * FROM marriages WHERE chat_id=? ORDER BY married_at",
-            (update.effective_chat.id,)).fetchall()
+    text, kb = await marriages_view(update.effective_chat.id)
+    if not text:
+        return await reply(update.message,
+            "💔 В этом чате пока нет ни одной пары...")
+
+    await reply(update.message,
+        text, parse_mode="HTML", reply_markup=kb)
+
+
+# cid -> {(cursor, back, дата): (строки, есть_ещё)}; сбрасывается
+# при свадьбе или разводе в чате, дата в ключе — чтобы дни не устаревали
+_mar_pages = LRU(1000)
+
 
+def forget_marriages(cid: int):
+    _mar_pages.pop(cid, None)
+
+
+async def marriages_view(cid: int, cursor=None, back=False, off=0):
+    """Текст и кнопки страницы /marriages; (None, None) если пар нет."""
+    pages = _mar_pages.get(cid)
+    if pages is None:
+        pages = {}
+        _mar_pages.put(cid, pages)
+    key = (cursor, back, datetime.now().date())
+    CACHE.inc("marriages", "hit" if key in pages else "miss")
+    if key not in pages:
+        pages[key] = await run_db(marriages_page, cid, cursor, back)
+    rows, more = pages[key]
     if not rows:
-        return await update.message.reply_text(
-            "💔 В этом чате пока нет ни одной пары...")
+        return None, None
+
+    has_prev, has_next = (more, True) if back else (off > 0, more)
+    if back and not more:
+        off = 0
 
     lines = ["💍 <b>Браки в этом чате:</b>\n"]
-    for i, r in enumerate(rows, 1):
-        days = (datetime.now() - parse_dt(r[8])).days
+    for i, r in enumerate(rows, off + 1):
         lines.append(
-            f"{i}. {mn(r[3],r[4])} ❤️ {mn(r[6],r[7])} — "
-            f"<i>{days} дн.</i>")
-
-    await update.message.reply_text(
-        "\n".join(lines), parse_mode="HTML")
+            f"{i}. {mn(r[2], r[3])} ❤️ {mn(r[4], r[5])} — "
+            f"<i>{r[6]} дн.</i>")
+
+    nav = []
+    if has_prev:
+        first = rows[0]
+        nav.append(InlineKeyboardButton(
+            "⬅️", callback_data=f"mpg_<_{off}_{first[0]}_{first[1]}"))
+    if has_next:
+        last = rows[-1]
+        nav.append(InlineKeyboardButton(
+            "➡️", callback_data=f"mpg_>_{off + len(rows)}_"
+                                f"{last[0]}_{last[1]}"))
+    return "\n".join(lines), InlineKeyboardMarkup([nav]) if nav else None
 
 # ══════════════════════════════════════════════════════════
 #  /divorce
@@ -527,14 +2494,14 @@ async def cmd_marriages(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 async def cmd_divorce(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     cache_user(update.effective_user)
     if update.effective_chat.type == "private":
-        return await update.message.reply_text(
+        return await reply(update.message,
             "❌ Эта команда только для групп!")
 
     uid = update.effective_user.id
     cid = update.effective_chat.id
-    mar = get_marriage(uid, cid)
+    mar = await run_db(get_marriage, uid, cid)
     if not mar:
-        return await update.message.reply_text("❌ Ты не в браке 🤷")
+        return await reply(update.message, "❌ Ты не в браке 🤷")
 
     partner = (mn(mar["u2n"], mar["u2u"])
                if mar["u1"] == uid
@@ -549,7 +2516,7 @@ async def cmd_divorce(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             callback_data=f"dno_{uid}"),
     ]])
 
-    await update.message.reply_text(
+    await reply(update.message,
         f"⚠️ <b>{update.effective_user.first_name}</b>, "
         f"ты точно хочешь развестись с <b>{partner}</b>?\n\n"
         f"Это действие нельзя отменить!",
@@ -562,44 +2529,113 @@ async def cmd_divorce(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 async def cmd_couple(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     cache_user(update.effective_user)
     if update.effective_chat.type == "private":
-        return await update.message.reply_text(
+        return await reply(update.message,
             "❌ Эта команда только для групп!")
 
     uid = update.effective_user.id
     cid = update.effective_chat.id
-    mar = get_marriage(uid, cid)
+    mar = await run_db(get_marriage, uid, cid)
     if not mar:
-        return await update.message.reply_text(
+        return await reply(update.message,
             "❌ Ты не в браке! Используй /marry 💍")
 
     dt = parse_dt(mar["date"])
     days = (datetime.now() - dt).days
-    msgs = msg_cnt(mar["u1"], cid) + msg_cnt(mar["u2"], cid)
-
-    wait = await update.message.reply_text("🎨 Генерирую картинку...")
-
-    av1 = await _avatar(ctx.bot, mar["u1"])
-    av2 = await _avatar(ctx.bot, mar["u2"])
+    msgs = (await run_db(msg_cnt, mar["u1"], cid)
+            + await run_db(msg_cnt, mar["u2"], cid))
 
     n1 = mn(mar["u1n"], mar["u1u"])
     n2 = mn(mar["u2n"], mar["u2u"])
+    caption = (
+        f"💍 <b>{n1}</b> ❤️ <b>{n2}</b>\n"
+        f"Вместе <b>{days}</b> дн. | "
+        f"💬 <b>{msgs}</b> сообщ.")
+    no_card = "\n\n<i>Картинку сейчас нарисовать не получилось 🙈</i>"
+
+    # та же статистика и те же аватарки — шлём уже загруженную карточку
+    ids = await asyncio.gather(
+        avatar_id(ctx.bot, mar["u1"]), avatar_id(ctx.bot, mar["u2"]))
+    key = card_key(cid, mar["id"])
+    sig = ":".join(map(str, (days, msgs, *(i and i[0] for i in ids))))
+    if await reply_cached_photo(
+            update.message, key, sig, caption=caption, parse_mode="HTML"):
+        return
+
+    if render_busy():
+        return await reply(update.message,
+            caption + no_card, parse_mode="HTML")
 
-    buf = build_card(av1, av2, n1, n2, days, msgs,
-                     dt.strftime("%d.%m.%Y"))
+    wait = await reply(update.message, "🎨 Генерирую картинку...")
 
-    await update.message.reply_photo(
-        buf,
-        caption=(
-            f"💍 <b>{n1}</b> ❤️ <b>{n2}</b>\n"
-            f"Вместе <b>{days}</b> дн. | "
-            f"💬 <b>{msgs}</b> сообщ."),
-        parse_mode="HTML")
+    av1, av2 = await asyncio.gather(
+        avatar(ctx.bot, mar["u1"]), avatar(ctx.bot, mar["u2"]))
+
+    png = await render(av1, av2, n1, n2, days, msgs,
+                       dt.strftime("%d.%m.%Y"))
+
+    if png:
+        sent = await reply_photo(update.message,
+            png, caption=caption, parse_mode="HTML")
+        await remember_file_id(key, sig, sent)
+    else:
+        await reply(update.message,
+            caption + no_card, parse_mode="HTML")
 
     try:
-        await wait.delete()
+        await outbox.send(update.effective_chat.id, wait.delete)
     except Exception:
         pass
 
+# ══════════════════════════════════════════════════════════
+#  /top
+# ══════════════════════════════════════════════════════════
+
+# доска -> (заголовок, кнопка)
+TOP_BOARDS = {
+    "d": ("🔥 Самые активные сегодня", "Сегодня"),
+    "w": ("📅 Самые активные за неделю", "Неделя"),
+    "a": ("🏆 Самые активные за всё время", "Всё время"),
+    "c": ("💞 Самые активные пары", "Пары"),
+}
+
+
+async def cmd_top(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    cache_user(update.effective_user)
+    if update.effective_chat.type == "private":
+        return await reply(update.message,
+            "❌ Эта команда только для групп!")
+
+    text, kb = await top_view(update.effective_chat.id)
+    await reply(update.message,
+        text, parse_mode="HTML", reply_markup=kb)
+
+
+async def top_view(cid: int, board: str = "w"):
+    """Текст и кнопки /top; топы готовые, отстают не больше чем на сброс."""
+    day = day_of()
+    bucket = {"d": day, "w": week_of(day)}.get(board, 0)
+    rows = await run_db(top_rows, cid, board, bucket)
+
+    lines = [f"<b>{TOP_BOARDS[board][0]}:</b>\n"]
+    if board == "c":
+        for i, r in enumerate(rows, 1):
+            lines.append(f"{i}. {mn(r[2], r[3])} ❤️ {mn(r[4], r[5])} — "
+                         f"<i>{r[1]} сообщ.</i>")
+    else:
+        users = await run_db(user_rows, [r[0] for r in rows])
+        for i, (uid, n) in enumerate(rows, 1):
+            u = users.get(uid)
+            lines.append(f"{i}. {mn(u[2], u[1]) if u else uid} — "
+                         f"<i>{n} сообщ.</i>")
+    if not rows:
+        lines.append("Пока никого 🤷")
+
+    kb = InlineKeyboardMarkup([[
+        InlineKeyboardButton(("• " if b == board else "") + label,
+                             callback_data=f"top_{b}")
+        for b, (_, label) in TOP_BOARDS.items()]])
+    return "\n".join(lines), kb
+
 # ══════════════════════════════════════════════════════════
 #  CALLBACK — КНОПКИ
 # ══════════════════════════════════════════════════════════
@@ -613,15 +2649,41 @@ async def on_callback(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     # ── показать команды ──
     if data == "cmds":
         await q.answer()
-        return await q.message.reply_text(
+        return await reply(q.message,
             "📜 <b>Команды:</b>\n\n"
             "💍 /marry <code>@ник</code> — предложить руку и сердце\n"
             "💒 /tomarry <code>@ник1 @ник2</code> — поженить двоих\n"
             "📋 /marriages — все пары чата\n"
             "📊 /couple — картинка-статистика пары\n"
+            "🏆 /top — самые активные участники и пары\n"
             "💔 /divorce — подать на развод",
             parse_mode="HTML")
 
+    # ── листание /marriages ──
+    # mpg_<dir>_<номер первой строки страницы>_<id>_<married_at>
+    if data.startswith("mpg_"):
+        _, d, off, mid, mdate = data.split("_", 4)
+        back = d == "<"
+        off = int(off)
+        text, kb = await marriages_view(
+            q.message.chat.id, (mdate, int(mid)), back,
+            max(off - MARRIAGES_PAGE, 0) if back else off)
+        await q.answer()
+        if text:
+            edit(q,
+                text, parse_mode="HTML", reply_markup=kb)
+        return
+
+    # ── переключение топов /top ──
+    if data.startswith("top_"):
+        board = data[4:]
+        await q.answer()
+        if board in TOP_BOARDS:
+            text, kb = await top_view(q.message.chat.id, board)
+            edit(q,
+                text, parse_mode="HTML", reply_markup=kb)
+        return
+
     # ── согласие ──
     if data.startswith("yes_"):
         parts = data.split("_")
@@ -631,56 +2693,23 @@ async def on_callback(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             return await q.answer(
                 "Эта кнопка не для тебя!", show_alert=True)
 
-        with _db() as c:
-            row = c.execute(
-                "SELECT * FROM pending WHERE id=?", (pid,)
-            ).fetchone()
-            if not row:
-                return await q.answer(
-                    "Предложение устарело!", show_alert=True)
-
-            # 0:id 1:cid 2:init 3:u1id 4:u1n 5:u1un
-            # 6:u2id 7:u2n 8:u2un 9:u1ok 10:u2ok 11:msgid
-            p = dict(id=row[0], cid=row[1], init=row[2],
-                     u1=row[3], u1n=row[4], u1u=row[5],
-                     u2=row[6], u2n=row[7], u2u=row[8],
-                     ok1=row[9], ok2=row[10])
-
-            if user.id == p["u1"]:
-                c.execute(
-                    "UPDATE pending SET u1_ok=1 WHERE id=?", (pid,))
-                p["ok1"] = 1
-            else:
-                c.execute(
-                    "UPDATE pending SET u2_ok=1 WHERE id=?", (pid,))
-                p["ok2"] = 1
+        p = await run_db(accept_pending, q.message.chat.id, pid, user.id)
+        if not p:
+            return await q.answer(
+                "Предложение устарело!", show_alert=True)
 
         await q.answer("✅ Принято!")
 
         # оба согласны → свадьба
         if p["ok1"] == 1 and p["ok2"] == 1:
-            with _db() as c:
-                c.execute(
-                    "INSERT INTO marriages"
-                    "(chat_id,user1_id,user1_name,user1_un,"
-                    "user2_id,user2_name,user2_un,married_at) "
-                    "VALUES(?,?,?,?,?,?,?,datetime('now'))",
-                    (p["cid"],
-                     p["u1"], p["u1n"], p["u1u"],
-                     p["u2"], p["u2n"], p["u2u"]))
-                c.execute(
-                    "DELETE FROM pending WHERE id=?", (pid,))
-
-            try:
-                await q.edit_message_text(
-                    f"🎊💒 <b>Совет да любовь!</b>\n\n"
-                    f"{mn(p['u1n'],p['u1u'])} и "
-                    f"{mn(p['u2n'],p['u2u'])} теперь в браке! 💍\n\n"
-                    f"📅 {datetime.now().strftime('%d.%m.%Y')}\n\n"
-                    f"Используйте /couple для статистики 💕",
-                    parse_mode="HTML")
-            except Exception:
-                pass
+            forget_marriages(p["cid"])
+            edit(q,
+                f"🎊💒 <b>Совет да любовь!</b>\n\n"
+                f"{mn(p['u1n'],p['u1u'])} и "
+                f"{mn(p['u2n'],p['u2u'])} теперь в браке! 💍\n\n"
+                f"📅 {datetime.now().strftime('%d.%m.%Y')}\n\n"
+                f"Используйте /couple для статистики 💕",
+                parse_mode="HTML")
         else:
             # ждём второго
             oid = p["u2"] if user.id == p["u1"] else p["u1"]
@@ -693,13 +2722,10 @@ async def on_callback(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
                     "❌ Отказать",
                     callback_data=f"no_{pid}_{oid}"),
             ]])
-            try:
-                await q.edit_message_text(
-                    f"✅ <b>{user.first_name}</b> согласен(на)!\n\n"
-                    f"Ждём ответа от <b>{onm}</b>... 💒",
-                    parse_mode="HTML", reply_markup=kb)
-            except Exception:
-                pass
+            edit(q,
+                f"✅ <b>{user.first_name}</b> согласен(на)!\n\n"
+                f"Ждём ответа от <b>{onm}</b>... 💒",
+                parse_mode="HTML", reply_markup=kb)
         return
 
     # ── отказ ──
@@ -711,18 +2737,14 @@ async def on_callback(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             return await q.answer(
                 "Эта кнопка не для тебя!", show_alert=True)
 
-        with _db() as c:
-            row = c.execute(
-                "SELECT * FROM pending WHERE id=?", (pid,)
-            ).fetchone()
-            if not row:
-                return await q.answer(
-                    "Предложение устарело!", show_alert=True)
-
-            init_id = row[2]
-            u1n, u2n = row[4], row[7]
-            u1id, u2id = row[3], row[6]
-            c.execute("DELETE FROM pending WHERE id=?", (pid,))
+        row = await run_db(reject_pending, q.message.chat.id, pid)
+        if not row:
+            return await q.answer(
+                "Предложение устарело!", show_alert=True)
+
+        init_id = row[2]
+        u1n, u2n = row[4], row[7]
+        u1id, u2id = row[3], row[6]
 
         await q.answer()
 
@@ -734,14 +2756,11 @@ async def on_callback(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         else:
             comfort = u1n  # /tomarry — сочувствуем всем
 
-        try:
-            await q.edit_message_text(
-                f"💔 <b>{user.first_name}</b> отказал(а)...\n\n"
-                f"<b>{comfort}</b>, не расстраивайся, "
-                f"всё ещё будет! 🫂",
-                parse_mode="HTML")
-        except Exception:
-            pass
+        edit(q,
+            f"💔 <b>{user.first_name}</b> отказал(а)...\n\n"
+            f"<b>{comfort}</b>, не расстраивайся, "
+            f"всё ещё будет! 🫂",
+            parse_mode="HTML")
         return
 
     # ── развод: да ──
@@ -753,27 +2772,21 @@ async def on_callback(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             return await q.answer(
                 "Эта кнопка не для тебя!", show_alert=True)
 
-        with _db() as c:
-            row = c.execute(
-                "SELECT * FROM marriages WHERE id=?", (mid,)
-            ).fetchone()
-            if not row:
-                return await q.answer(
-                    "Брак уже расторгнут!", show_alert=True)
-
-            days = (datetime.now() - parse_dt(row[8])).days
-            u1m = mn(row[3], row[4])
-            u2m = mn(row[6], row[7])
-            c.execute("DELETE FROM marriages WHERE id=?", (mid,))
+        row = await run_db(divorce, q.message.chat.id, mid)
+        if not row:
+            return await q.answer(
+                "Брак уже расторгнут!", show_alert=True)
+        forget_marriages(row[1])
+
+        days = (datetime.now() - parse_dt(row[8])).days
+        u1m = mn(row[3], row[4])
+        u2m = mn(row[6], row[7])
 
         await q.answer()
-        try:
-            await q.edit_message_text(
-                f"📜 Брак между <b>{u1m}</b> и <b>{u2m}</b> "
-                f"расторгнут.\nБыли вместе <b>{days}</b> дн. 💔",
-                parse_mode="HTML")
-        except Exception:
-            pass
+        edit(q,
+            f"📜 Брак между <b>{u1m}</b> и <b>{u2m}</b> "
+            f"расторгнут.\nБыли вместе <b>{days}</b> дн. 💔",
+            parse_mode="HTML")
         return
 
     # ── развод: нет ──
@@ -783,13 +2796,10 @@ async def on_callback(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             return await q.answer(
                 "Эта кнопка не для тебя!", show_alert=True)
         await q.answer()
-        try:
-            await q.edit_message_text(
-                f"❤️ <b>{user.first_name}</b> сохранил(а) брак!\n"
-                f"Любовь победила! 🎉",
-                parse_mode="HTML")
-        except Exception:
-            pass
+        edit(q,
+            f"❤️ <b>{user.first_name}</b> сохранил(а) брак!\n"
+            f"Любовь победила! 🎉",
+            parse_mode="HTML")
 
 # ══════════════════════════════════════════════════════════
 #  СЧЁТЧИК СООБЩЕНИЙ + КЕШ ЮЗЕРОВ
@@ -802,35 +2812,561 @@ async def on_message(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         return
     cache_user(update.effective_user)
     inc_msg(update.effective_user.id, update.effective_chat.id)
+    if len(wb) >= FLUSH_MAX:
+        await run_db(wb.flush)
 
 # ══════════════════════════════════════════════════════════
-#  ЗАПУСК
+#  ИСТЕЧЕНИЕ ПРЕДЛОЖЕНИЙ
 # ══════════════════════════════════════════════════════════
 
-def main():
+async def _sweeper(bot):
+    while True:
+        try:
+            rows = await run_db(expire_pending, SWEEP_BATCH)
+            old = await run_db(expire_rollups, SWEEP_BATCH)
+        except sqlite3.Error:
+            log.exception("sweeper: не удалось удалить просроченные")
+            rows, old = [], 0
+        for cid, msg_id in rows:
+            if not msg_id:
+                continue
+            outbox.edit(cid, msg_id, partial(
+                bot.edit_message_text,
+                "⌛ Предложение истекло — ответа так и не было.",
+                chat_id=cid, message_id=msg_id))
+        if rows:
+            log.info("sweeper: удалено %d просроченных предложений",
+                     len(rows))
+        # папка аватарок общая на всех воркеров — чистит один
+        if _owner[0] == 0:
+            try:
+                n = await asyncio.get_running_loop().run_in_executor(
+                    None, prune_avatars)
+                if n:
+                    log.info("sweeper: удалено %d старых аватарок", n)
+            except OSError:
+                log.exception("sweeper: не удалось почистить %s",
+                              AVATAR_DIR)
+        # полная пачка — вероятно, есть ещё, не ждём
+        if len(rows) < SWEEP_BATCH and old < SWEEP_BATCH:
+            await asyncio.sleep(SWEEP_INTERVAL)
+
+# ══════════════════════════════════════════════════════════
+#  ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА
+# ══════════════════════════════════════════════════════════
+
+class UpdateQueue(asyncio.Queue):
+    """update_queue с пределом на апдейты в работе.
+
+    При concurrent_updates PTB делает задачу из каждого апдейта сразу,
+    как достал его из очереди, — сама очередь так не заполнится никогда.
+    Поэтому get() отдаёт апдейт, только пока в работе их меньше limit, а
+    место освобождает release() из ChatOrderedProcessor. Тогда очередь
+    заполняется, и put() приёмника (polling или webhook) ждёт.
+    """
+
+    def __init__(self, limit: int = UPDATE_QUEUE_SIZE):
+        super().__init__(maxsize=limit)
+        self._inflight = asyncio.Semaphore(limit)
+        self._taken = set()     # id выданных и ещё не обработанных
+
+    async def get(self):
+        await self._inflight.acquire()
+        try:
+            item = await super().get()
+        except BaseException:
+            self._inflight.release()
+            raise
+        if isinstance(item, Update):
+            self._taken.add(id(item))
+        else:               # сигнал остановки PTB и прочее служебное
+            self._inflight.release()
+        return item
+
+    def release(self, update):
+        """Апдейт обработан; повторный вызов и чужие апдейты — no-op."""
+        if id(update) in self._taken:
+            self._taken.discard(id(update))
+            self._inflight.release()
+
+
+class ChatOrderedProcessor(BaseUpdateProcessor):
+    """Разные чаты — параллельно, апдейты одного чата — строго по порядку.
+
+    Так два одновременных «Согласен» в on_callback не обгоняют друг друга.
+    Апдейты в работе ограничивает UpdateQueue, которой processor отпускает
+    апдейт по готовности, а self._slots — число реально работающих. Один
+    чат занимает не больше четверти предела очереди, остальные его
+    апдейты ждут своей очереди, вернув место: иначе хвост чата,
+    упёршегося в лимит ответов, выбрал бы весь предел, и другие чаты
+    ждали бы его. Сверх CHAT_UPDATES апдейты чата отбрасываются.
+    """
+
+    def __init__(self, workers: int = CONCURRENT_UPDATES,
+                 queue: Optional[UpdateQueue] = None):
+        # ждущие свой чат без места в очереди тоже задачи — семафор
+        # базового класса не должен их считать
+        super().__init__(sys.maxsize if queue else max(workers, 1))
+        self._slots = asyncio.Semaphore(workers)
+        self._queue = queue
+        self._share = max(queue.maxsize // 4, 1) if queue else 0
+        # ключ -> [Lock, сколько апдейтов держат/ждут, сколько отброшено]
+        self._chats = {}
+
+    @staticmethod
+    def _key(update):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:   # inline-запросы и прочее без чата
+            return ("user", update.effective_user.id)
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        try:
+            await self._ordered(update, coroutine)
+        finally:
+            if self._queue:
+                self._queue.release(update)
+
+    async def _ordered(self, update, coroutine):
+        t = time.perf_counter()
+        key = self._key(update)
+        if key is None:
+            async with self._slots:
+                UPDATE_WAIT.observe(time.perf_counter() - t)
+                await self._track(update, coroutine)
+            UPDATES.inc()
+            return
+        entry = self._chats.get(key)
+        if entry is None:
+            entry = self._chats[key] = [asyncio.Lock(), 0, 0]
+        if entry[1] >= CHAT_UPDATES:
+            coroutine.close()
+            entry[2] += 1
+            UPDATES_DROPPED.inc()
+            return
+        entry[1] += 1
+        if self._queue and entry[1] > self._share:
+            self._queue.release(update)
+        try:
+            # сначала очередь своего чата, потом общий слот: ждущие
+            # апдейты одного шумного чата не занимают слоты других
+            async with entry[0], self._slots:
+                UPDATE_WAIT.observe(time.perf_counter() - t)
+                await self._track(update, coroutine)
+            UPDATES.inc()
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chats[key]
+                if entry[2]:
+                    log.warning("чат %s не успевал: отброшено апдейтов %d",
+                                key, entry[2])
+
+    @staticmethod
+    async def _track(update, coroutine):
+        # хендлеры выполняются в этой же задаче — сторож найдёт апдейт по ней
+        task = asyncio.current_task()
+        _running[task] = update
+        try:
+            await coroutine
+        finally:
+            del _running[task]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+# ══════════════════════════════════════════════════════════
+#  НЕСКОЛЬКО ПРОЦЕССОВ
+# ══════════════════════════════════════════════════════════
+# Приёмник (polling/webhook) раздаёт апдейты K процессам-обработчикам по
+# тому же shard_of(chat_id), что и шарды БД: при WORKERS == DB_SHARDS
+# в каждый файл пишет ровно один процесс. Каналы — два socketpair, кадры —
+# 4 байта длины + JSON. По основному {"u": апдейт} | {"stop": 1} туда и
+# {"done": i} обратно; по служебному {"ping": n} туда и {"pong": n}
+# обратно: занятый воркер (полная update_queue) читает апдейты медленно,
+# но на ping отвечает сразу.
+
+async def _send_frame(w: asyncio.StreamWriter, obj: dict):
+    data = json.dumps(obj, ensure_ascii=False).encode()
+    w.write(len(data).to_bytes(4, "big") + data)
+    await w.drain()
+
+
+async def _read_frame(r: asyncio.StreamReader) -> Optional[dict]:
+    """Следующий кадр или None, если другая сторона закрыла сокет."""
+    try:
+        n = int.from_bytes(await r.readexactly(4), "big")
+        return json.loads(await r.readexactly(n))
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+
+
+def _worker_main(i: int, k: int, sock: socket.socket, ctl: socket.socket):
+    # Ctrl+C и SIGTERM получает вся группа, а останавливает нас приёмник —
+    # после того как отдаст всё принятое
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    # до post_init профайлера ещё нет, а по умолчанию SIGUSR1 убивает
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    global METRICS_PORT, _owner
+    _owner = (i, k)
+    if METRICS_PORT:
+        METRICS_PORT += i
     init_db()
-    app = Application.builder().token(BOT_TOKEN).build()
+    startup_mark("БД")
+    outbox.share(k)
+    asyncio.run(_worker(i, sock, ctl))
+
+
+async def _pongs(r: asyncio.StreamReader, w: asyncio.StreamWriter):
+    try:
+        while (msg := await _read_frame(r)) is not None:
+            await _send_frame(w, {"pong": msg["ping"]})
+    except ConnectionError:
+        pass
+
+
+async def _worker(i: int, sock: socket.socket, ctl: socket.socket):
+    r, w = await asyncio.open_connection(sock=sock)
+    pongs = asyncio.create_task(
+        _pongs(*await asyncio.open_connection(sock=ctl)))
+    app = build_app()
+    startup_mark("приложение")
+    await app.initialize()
+    await post_init(app)
+    await app.start()
+    log.info("воркер %d готов", i)
+    try:
+        while (msg := await _read_frame(r)) is not None:
+            if "u" in msg:
+                await app.update_queue.put(Update.de_json(msg["u"], app.bot))
+            elif "stop" in msg:
+                break
+    finally:
+        pongs.cancel()
+        # stop() дорабатывает всё, что уже лежит в update_queue
+        await app.stop()
+        await post_stop(app)
+        await app.shutdown()
+        await post_shutdown(app)
+        log.info("воркер %d остановлен", i)
+        try:
+            await _send_frame(w, {"done": i})
+            w.close()
+        except ConnectionError:
+            pass
+
+
+class WorkerProc:
+    """Процесс-обработчик глазами приёмника."""
+
+    def __init__(self, i: int, k: int):
+        self.i, self.k = i, k
+        self.proc = self.w = self._ctl = None
+        self._readers = []
+        self.pong = 0.0
+        self.done = asyncio.Event()
+        # снят, пока воркер перезапускается: forward держит апдейт у себя
+        self.ready = asyncio.Event()
+        # свои очередь и отправитель: застрявший воркер (полный буфер
+        # сокета) не задерживает апдейты остальным
+        self.queue = asyncio.Queue(maxsize=max(UPDATE_QUEUE_SIZE // k, 1))
+
+    async def start(self):
+        parent, child = socket.socketpair()
+        ctl_parent, ctl_child = socket.socketpair()
+        self.proc = multiprocessing.get_context("spawn").Process(
+            target=_worker_main, args=(self.i, self.k, child, ctl_child),
+            name=f"worker-{self.i}")
+        self.proc.start()
+        child.close()
+        ctl_child.close()
+        r, self.w = await asyncio.open_connection(sock=parent)
+        ctl, self._ctl = await asyncio.open_connection(sock=ctl_parent)
+        # запуск небыстрый (spawn, get_me) — считаем его первым pong
+        self.pong = time.monotonic()
+        self.done.clear()
+        self._readers = [asyncio.create_task(self._read(r)),
+                         asyncio.create_task(self._read(ctl))]
+        self.ready.set()
+
+    async def _read(self, r: asyncio.StreamReader):
+        while (msg := await _read_frame(r)) is not None:
+            if "pong" in msg:
+                self.pong = time.monotonic()
+            elif "done" in msg:
+                break
+        self.done.set()
+
+    async def send(self, obj: dict):
+        await _send_frame(self.w, obj)
+
+    async def ping(self, n: int):
+        await _send_frame(self._ctl, {"ping": n})
+
+    async def forward(self):
+        """Отправлять апдейты из self.queue, пока задачу не отменят."""
+        while True:
+            update = await self.queue.get()
+            try:
+                # не отправленный апдейт ждёт перезапуска воркера
+                while True:
+                    await self.ready.wait()
+                    try:
+                        await self.send({"u": update.to_dict()})
+                        break
+                    except ConnectionError:
+                        log.warning("воркер %d недоступен, апдейт %d "
+                                    "ждёт перезапуска",
+                                    self.i, update.update_id)
+                        self.ready.clear()
+            finally:
+                self.queue.task_done()
+
+    def healthy(self) -> bool:
+        return (self.proc.is_alive() and self.ready.is_set()
+                and not self.done.is_set()
+                and time.monotonic() - self.pong < WORKER_PING_TIMEOUT)
+
+    async def _join(self):
+        await asyncio.get_running_loop().run_in_executor(
+            None, self.proc.join)
+
+    async def restart(self):
+        log.error("воркер %d не отвечает (код выхода %s), перезапуск",
+                  self.i, self.proc.exitcode)
+        self.ready.clear()
+        for t in self._readers:
+            t.cancel()
+        self.w.close()
+        self._ctl.close()
+        self.proc.kill()
+        await self._join()
+        await self.start()
+
+    async def stop(self, timeout: float):
+        try:
+            await asyncio.wait_for(self.send({"stop": 1}), timeout)
+            await asyncio.wait_for(self.done.wait(), timeout)
+        except (asyncio.TimeoutError, ConnectionError):
+            log.warning("воркер %d не завершился сам, убиваем", self.i)
+            self.proc.kill()
+        await self._join()
+
 
-    app.add_handler(CommandHandler("start", cmd_start))
-    app.add_handler(CommandHandler("help", cmd_start))
-    app.add_handler(CommandHandler("tomarry", cmd_tomarry))
-    app.add_handler(CommandHandler("marry", cmd_marry))
-    app.add_handler(CommandHandler("marriages", cmd_marriages))
-    app.add_handler(CommandHandler("divorce", cmd_divorce))
-    app.add_handler(CommandHandler("couple", cmd_couple))
-    app.add_handler(CallbackQueryHandler(on_callback))
+def worker_for(update: Update, workers: list) -> WorkerProc:
+    key = ChatOrderedProcessor._key(update)
+    if isinstance(key, tuple):      # ("user", uid)
+        key = key[1]
+    return workers[shard_of(key or 0, len(workers))]
+
+
+async def _route(updates: asyncio.Queue, workers: list):
+    while True:
+        update = await updates.get()
+        try:
+            await worker_for(update, workers).queue.put(update)
+        finally:
+            updates.task_done()
+
+
+async def _drained(updates: asyncio.Queue, workers: list):
+    """Всё принятое разложено по воркерам и отправлено им."""
+    await updates.join()
+    await asyncio.gather(*(wk.queue.join() for wk in workers))
+
+
+async def _health(workers: list):
+    n = 0
+    while True:
+        await asyncio.sleep(WORKER_PING)
+        n += 1
+        for wk in workers:
+            if wk.healthy():
+                try:
+                    await asyncio.wait_for(wk.ping(n), WORKER_PING_TIMEOUT)
+                    continue
+                except (asyncio.TimeoutError, ConnectionError):
+                    pass
+            await wk.restart()
+
+
+async def serve_workers(k: int):
+    """Приёмник апдейтов + k процессов-обработчиков до SIGINT/SIGTERM."""
+    bot = (Bot(BOT_TOKEN, base_url=f"{BOT_API_URL}/bot",
+               base_file_url=f"{BOT_API_URL}/file/bot")
+           if BOT_API_URL else Bot(BOT_TOKEN))
+    updates = asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE)
+    updater = Updater(bot, updates)
+    workers = [WorkerProc(i, k) for i in range(k)]
+    for wk in workers:
+        await wk.start()
+    startup_mark("воркеры")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    def usr1():
+        # профиль приёмника и всех воркеров разом, у каждого свой файл
+        start_profile()
+        for wk in workers:
+            if wk.proc.is_alive():
+                os.kill(wk.proc.pid, signal.SIGUSR1)
+    loop.add_signal_handler(signal.SIGUSR1, usr1)
+    watchdog = Watchdog()
+    watchdog.start()
+
+    tasks = []
+    try:
+        async with updater:
+            if UPDATES_MODE == "webhook":
+                await updater.start_webhook(**webhook_args())
+            else:
+                await updater.start_polling(drop_pending_updates=True)
+            tasks = [asyncio.create_task(_route(updates, workers)),
+                     asyncio.create_task(_health(workers)),
+                     *(asyncio.create_task(wk.forward()) for wk in workers)]
+            log.info("🚀 Бот запущен (%s, воркеров: %d)!", UPDATES_MODE, k)
+            startup_report("приём")
+            await stop.wait()
+            log.info("остановка: дорабатываем принятые апдейты")
+            # больше не принимаем, но всё принятое отдаём воркерам
+            await updater.stop()
+            try:
+                await asyncio.wait_for(_drained(updates, workers),
+                                       WORKER_DRAIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                log.warning("не раздано %d апдейтов", updates.qsize()
+                            + sum(wk.queue.qsize() for wk in workers))
+    finally:
+        watchdog.stop()
+        for t in tasks:
+            t.cancel()
+        # и при ошибке приёмника: иначе выход ждёт живых воркеров вечно
+        await asyncio.gather(
+            *(wk.stop(WORKER_DRAIN_TIMEOUT) for wk in workers))
+
+# ══════════════════════════════════════════════════════════
+#  ЗАПУСК
+# ══════════════════════════════════════════════════════════
+
+async def post_init(app: Application):
+    startup_mark("initialize")
+    start_render_pool()
+    if RENDER_PRELOAD:
+        # не ждём: по заданию на воркер пула, какой возьмёт — тот и прогрет
+        for _ in range(RENDER_WORKERS):
+            _render_pool.submit(warm_render)
+    app.bot_data["metrics"] = await start_metrics()
+    app.bot_data["watchdog"] = Watchdog()
+    app.bot_data["watchdog"].start()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1,
+                                                  start_profile)
+    app.bot_data["tasks"] = [
+        asyncio.create_task(_flusher()),
+        asyncio.create_task(_sweeper(app.bot)),
+    ]
+    startup_report("post_init")
+
+
+async def post_stop(app: Application):
+    # бот ещё может слать — отправить хвост исходящих
+    await outbox.drain(OUT_DRAIN_TIMEOUT)
+
+
+async def post_shutdown(app: Application):
+    for task in app.bot_data.pop("tasks", []):
+        task.cancel()
+    if app.bot_data.get("metrics"):
+        app.bot_data.pop("metrics").close()
+    if app.bot_data.get("watchdog"):
+        app.bot_data.pop("watchdog").stop()
+        asyncio.get_running_loop().remove_signal_handler(signal.SIGUSR1)
+    await run_db(wb.flush)
+    _db_pool.shutdown()
+    if _render_pool:
+        _render_pool.shutdown(cancel_futures=True)
+    close_db()
+
+
+def build_app(token: str = BOT_TOKEN) -> Application:
+    # приём апдейтов ждёт, если хендлеры не успевают, вместо того чтобы
+    # копить их в памяти без конца
+    updates = UpdateQueue()
+    builder = (Application.builder().token(token)
+               .update_queue(updates)
+               .concurrent_updates(ChatOrderedProcessor(queue=updates))
+               .post_init(post_init)
+               .post_stop(post_stop)
+               .post_shutdown(post_shutdown))
+    if BOT_API_URL:
+        builder = (builder.base_url(f"{BOT_API_URL}/bot")
+                   .base_file_url(f"{BOT_API_URL}/file/bot"))
+    app = builder.build()
+
+    app.add_handler(CommandHandler("start", timed(cmd_start)))
+    app.add_handler(CommandHandler("help", timed(cmd_start)))
+    app.add_handler(CommandHandler("tomarry", timed(cmd_tomarry)))
+    app.add_handler(CommandHandler("marry", timed(cmd_marry)))
+    app.add_handler(CommandHandler("marriages", timed(cmd_marriages)))
+    app.add_handler(CommandHandler("divorce", timed(cmd_divorce)))
+    app.add_handler(CommandHandler("couple", timed(cmd_couple)))
+    app.add_handler(CommandHandler("top", timed(cmd_top)))
+    app.add_handler(CallbackQueryHandler(timed(on_callback)))
 
     # group=1 → работает ПАРАЛЛЕЛЬНО с остальными хендлерами,
     # считает ВСЕ сообщения и кеширует юзеров
     app.add_handler(
         MessageHandler(filters.ALL & filters.ChatType.GROUPS,
-                       on_message),
+                       timed(on_message)),
         group=1,
     )
+    return app
+
+
+def webhook_args() -> dict:
+    if not WEBHOOK_URL:
+        raise SystemExit("UPDATES_MODE=webhook требует WEBHOOK_URL")
+    # накопившееся за время рестарта не выбрасываем
+    return dict(
+        listen=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        url_path=urlparse(WEBHOOK_URL).path.lstrip("/"),
+        webhook_url=WEBHOOK_URL,
+        secret_token=WEBHOOK_SECRET or secrets.token_urlsafe(32),
+        drop_pending_updates=False,
+    )
+
+
+def main():
+    # миграции и проверка раскладки — один раз, до запуска воркеров
+    init_db()
+    startup_mark("БД")
+    if WORKERS > 0:
+        close_db()
+        asyncio.run(serve_workers(WORKERS))
+        return
+
+    app = build_app()
+    startup_mark("приложение")
+    if UPDATES_MODE == "webhook":
+        args = webhook_args()
+        log.info("🚀 Бот запущен (webhook, порт %d)!", WEBHOOK_PORT)
+        app.run_webhook(**args)
+    else:
+        log.info("🚀 Бот запущен!")
+        app.run_polling(drop_pending_updates=True)
 
-    log.info("🚀 Бот запущен!")
-    app.run_polling(drop_pending_updates=True)
 
+startup_mark("модуль")
 
 if __name__ == "__main__":
     main()
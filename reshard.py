@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+🗂 Переразложить браки, предложения и счётчики по N шардам
+python reshard.py N
+
+Только при остановленном боте! Потом запускать с DB_SHARDS=N.
+"""
+
+import argparse
+import os
+import sqlite3
+
+import main
+
+TABLES = ("marriages", "pending", "msg_cnt",
+          "msg_daily", "msg_weekly", "top")
+
+
+def _rm(path):
+    for p in (path, path + "-wal", path + "-shm"):
+        if os.path.exists(p):
+            os.remove(p)
+
+
+def _max_id(paths) -> int:
+    """Наибольший когда-либо выданный id по всем текущим шардам."""
+    top = 0
+    for p in paths:
+        c = sqlite3.connect(p)
+        for (seq,) in c.execute("SELECT seq FROM sqlite_sequence "
+                                "WHERE name IN ('marriages', 'pending')"):
+            top = max(top, seq or 0)
+        c.close()
+    return top
+
+
+def _fill(c, sources, i, n):
+    """Перенести в c строки чатов шарда i из всех старых файлов.
+
+    c открыт с uri=True, иначе ATTACH не поймёт mode=ro.
+    """
+    c.create_function("shard_of", 2, main.shard_of, deterministic=True)
+    for src in sources:
+        c.execute("ATTACH DATABASE ? AS old", (f"file:{src}?mode=ro",))
+        for t in TABLES:
+            c.execute(f"INSERT INTO main.{t} SELECT * FROM old.{t} "
+                      f"WHERE shard_of(chat_id, ?)=?", (n, i))
+        c.commit()
+        c.execute("DETACH DATABASE old")
+
+
+def reshard(n: int):
+    if not os.path.exists(main.DB_PATH):
+        raise SystemExit(f"{main.DB_PATH} не найден")
+    g = sqlite3.connect(main.DB_PATH)
+    main.migrate(g)
+    old_n = main.shard_layout(g) or 1
+    if old_n == n:
+        print(f"уже {n} шард(ов), ничего не делаем")
+        return
+    old, new = main.shard_paths(old_n), main.shard_paths(n)
+    # новые id — выше всех старых, диапазоны шардов не пересекаются
+    span = main.SHARD_ID_SPAN
+    base = (_max_id(old) // span + 1) * span
+
+    if n == 1:
+        # всё обратно в общий файл
+        g.close()
+        c = sqlite3.connect(main.DB_PATH, uri=True)
+        _fill(c, old, 0, 1)
+        main.seed_ids(c, base)
+        c.commit()
+        c.close()
+        for p in old:
+            _rm(p)
+    else:
+        tmp = [p + ".new" for p in new]
+        for i, p in enumerate(tmp):
+            _rm(p)
+            c = sqlite3.connect(p, uri=True)
+            main.migrate(c, p)
+            _fill(c, old, i, n)
+            main.seed_ids(c, base + i * span)
+            c.commit()
+            c.close()
+        g.close()
+        # старые — в .old, пока новые не на месте: сбой не теряет данных
+        if old_n > 1:
+            for p in old:
+                os.replace(p, p + ".old")
+        for t, p in zip(tmp, new):
+            os.replace(t, p)
+        if old_n == 1:
+            c = sqlite3.connect(main.DB_PATH)
+            for t in TABLES:
+                c.execute(f"DELETE FROM {t}")
+            c.commit()
+            c.execute("VACUUM")
+            c.close()
+        else:
+            for p in old:
+                _rm(p + ".old")
+
+    c = sqlite3.connect(main.DB_PATH)
+    c.execute("INSERT OR REPLACE INTO settings VALUES('shards', ?)", (n,))
+    c.commit()
+    c.close()
+    print(f"{old_n} → {n} шард(ов): {', '.join(new)}")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("n", type=int, help="сколько шардов сделать")
+    a = ap.parse_args()
+    if a.n < 1:
+        raise SystemExit("N ≥ 1")
+    reshard(a.n)
@@ -0,0 +1,32 @@
+"""Планы горячих запросов: ни одного SCAN и ни одной TEMP B-TREE."""
+
+import os
+
+import pytest
+
+import main
+
+
+@pytest.fixture(params=[1, 2], ids=["1-shard", "2-shards"])
+def fresh_db(request, tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "DB_PATH", os.path.join(tmp_path, "w.db"))
+    monkeypatch.setattr(main, "DB_SHARDS", request.param)
+    main.init_db()
+    yield
+    main.close_db()
+    main._db_pool.shutdown()
+
+
+def test_hot_queries_use_indexes(fresh_db):
+    for s in dict.fromkeys(main.shards):
+        with s.read() as c:
+            assert main.full_scans(c) == [], s.path
+
+
+def test_full_index_scan_is_flagged(fresh_db, monkeypatch):
+    # по индексу, но всё равно весь индекс: SCAN ... USING COVERING INDEX
+    monkeypatch.setitem(main.HOT_QUERIES, "bad_scan",
+                        "SELECT count(*) FROM msg_daily")
+    with main.db.read() as c:
+        bad = main.full_scans(c)
+    assert len(bad) == 1 and bad[0].startswith("bad_scan: SCAN ")
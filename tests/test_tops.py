@@ -0,0 +1,121 @@
+"""Топы /top, которые ведёт сброс, против пересчёта rebuild_tops()."""
+
+import os
+import random
+import threading
+
+import pytest
+
+import main
+
+CHATS = [-1_000_000_001, -1_000_000_002, -1_000_000_003]
+USERS = range(1, 13)
+
+
+@pytest.fixture(params=[1, 2], ids=["1-shard", "2-shards"])
+def fresh_db(request, tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "DB_PATH", os.path.join(tmp_path, "w.db"))
+    monkeypatch.setattr(main, "DB_SHARDS", request.param)
+    # мест меньше, чем людей, — чтобы состав топов менялся
+    monkeypatch.setattr(main, "TOP_SIZE", 3)
+    main._tops.clear()
+    main.init_db()
+    yield
+    main.close_db()
+    main._db_pool.shutdown()
+    main._tops.clear()
+
+
+def _snapshot() -> dict:
+    """(cid, доска, ведро) -> (строк в top, итоги по местам)."""
+    out, keys = {}, []
+    for s in dict.fromkeys(main.shards):
+        with s.read() as c:
+            keys += c.execute("SELECT chat_id, board, bucket, count(*) "
+                             "FROM top GROUP BY 1, 2, 3").fetchall()
+    for cid, board, bucket, n in keys:
+        # при равных итогах место может занять любой из них
+        out[cid, board, bucket] = (n, sorted(
+            r[1] for r in main.top_rows(cid, board, bucket)))
+    return out
+
+
+def _rebuilt() -> dict:
+    for s in dict.fromkeys(main.shards):
+        with s.write() as c:
+            main.rebuild_tops(c)
+    return _snapshot()
+
+
+def _user(uid: int) -> dict:
+    return dict(id=uid, name=f"u{uid}", un=None)
+
+
+def _marry(rnd: random.Random, cid: int):
+    u1, u2 = rnd.sample(USERS, 2)
+    pid = main.create_pending(cid, u1, _user(u1), _user(u2), u1_ok=1)
+    main.accept_pending(cid, pid, u2)
+
+
+def _divorce(rnd: random.Random, cid: int):
+    page = main.marriages_page(cid)[0]
+    if page:
+        main.divorce(cid, rnd.choice(page)[0])
+
+
+def _step(rnd: random.Random):
+    cid = rnd.choice(CHATS)
+    x = rnd.random()
+    if x < 0.1:
+        _marry(rnd, cid)
+    elif x < 0.15:
+        _divorce(rnd, cid)
+    else:
+        for _ in range(rnd.randint(1, 5)):
+            main.wb.add_msg(rnd.choice(USERS), cid)
+
+
+def test_interleaved(fresh_db):
+    rnd = random.Random(1)
+    for i in range(600):
+        _step(rnd)
+        if i % 7 == 0:
+            main.wb.flush()
+    main.wb.flush()
+    assert len(main.wb) == 0
+    assert _snapshot() == _rebuilt()
+
+
+class _RacyTops(dict):
+    """_tops, у которого перед обновлением копии женится другой поток."""
+
+    hook = thread = None
+
+    def update(self, boards):
+        if self.hook:
+            self.thread = threading.Thread(target=self.hook)
+            self.thread.start()
+            # под замком писателя свадьба дождётся конца сброса
+            self.thread.join(0.2)
+            self.hook = None
+        super().update(boards)
+
+
+def test_wedding_during_flush(fresh_db, monkeypatch):
+    tops = _RacyTops()
+    monkeypatch.setattr(main, "_tops", tops)
+    cid = CHATS[0]
+    pid = main.create_pending(cid, 1, _user(1), _user(2), u1_ok=1)
+    main.accept_pending(cid, pid, 2)
+    main.wb.add_msg(1, cid)
+    main.wb.flush()
+    # свадьба — между commit пачки и обновлением копии топа пар
+    pid = main.create_pending(cid, 3, _user(3), _user(4), u1_ok=1)
+    tops.hook = lambda: main.accept_pending(cid, pid, 4)
+    main.wb.add_msg(1, cid)
+    main.wb.flush()
+    tops.thread.join()
+    main.wb.add_msg(3, cid)
+    main.wb.flush()
+    assert len(main.wb) == 0      # ни один сброс не упал
+    assert _snapshot() == _rebuilt()
@@ -0,0 +1,67 @@
+"""UpdateQueue и ChatOrderedProcessor: шумный чат не держит остальные."""
+
+import asyncio
+
+from telegram import Update
+
+import main
+
+NOISY, QUIET = -1_000_000_001, -1_000_000_002
+
+
+def _update(n: int, cid: int) -> Update:
+    return Update.de_json({"update_id": n, "message": {
+        "message_id": n, "date": 0, "text": "привет",
+        "chat": {"id": cid, "type": "supergroup"}}}, None)
+
+
+def _run(n: int) -> tuple:
+    """n апдейтов шумного чата, чьи хендлеры висят, и один — тихого.
+
+    -> (обработан ли тихий, сколько хендлеров шумного запущено)."""
+    async def run():
+        queue = main.UpdateQueue(limit=20)
+        processor = main.ChatOrderedProcessor(64, queue=queue)
+        stuck = asyncio.Event()     # ответы шумного чата упёрлись в лимит
+        quiet = asyncio.Event()
+        tasks = []
+
+        started = []
+
+        async def handler(update):
+            if update.effective_chat.id == NOISY:
+                started.append(update.update_id)
+                await stuck.wait()
+            else:
+                quiet.set()
+
+        async def dispatch():
+            # то же, что делает Application при concurrent_updates
+            while True:
+                update = await queue.get()
+                tasks.append(asyncio.create_task(
+                    processor.process_update(update, handler(update))))
+
+        task = asyncio.create_task(dispatch())
+        try:
+            for i in range(n):
+                await asyncio.wait_for(queue.put(_update(i, NOISY)), 1)
+            await asyncio.wait_for(queue.put(_update(n, QUIET)), 1)
+            await asyncio.wait_for(quiet.wait(), 1)
+        finally:
+            stuck.set()
+            task.cancel()
+            await asyncio.gather(*tasks)
+        return quiet.is_set(), len(started)
+
+    return asyncio.run(run())
+
+
+def test_noisy_chat_does_not_starve_others():
+    # очередь на 20, а шумный чат прислал вдвое больше — и все дождутся
+    assert _run(40) == (True, 40)
+
+
+def test_noisy_chat_overflow_is_dropped(monkeypatch):
+    monkeypatch.setattr(main, "CHAT_UPDATES", 30)
+    assert _run(40) == (True, 30)
@@ -0,0 +1,101 @@
+"""Режим webhook против фейкового Bot API из loadtest.py."""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+import loadtest
+import main
+
+SECRET = "test-secret"
+CID, UID = -1_000_000_000, 1000
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def fake_api():
+    # тот же сервер, что у нагрузочного прогона, только без своих апдейтов
+    a = argparse.Namespace(replay=None, save=None, seed=1, rate=0,
+                           updates=0, chats=1, members=1, accept=1,
+                           divorce=1, mix_msg=1, mix_marry=0, mix_couple=0,
+                           mix_marriages=0, mix_divorce=0, mix_top=0)
+    port = _free_port()
+    threading.Thread(target=loadtest.serve, args=(port, a),
+                     daemon=True).start()
+    for _ in range(100):
+        try:
+            loadtest.stats(port)
+            break
+        except OSError:
+            time.sleep(0.05)
+    return port
+
+
+def _post(url: str, secret: str, body: dict) -> int:
+    req = urllib.request.Request(
+        url, json.dumps(body).encode(), method="POST",
+        headers={"content-type": "application/json",
+                 "X-Telegram-Bot-Api-Secret-Token": secret})
+    try:
+        with urllib.request.urlopen(req, timeout=5) as r:
+            return r.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def test_webhook(fake_api, tmp_path, monkeypatch):
+    hook = _free_port()
+    for name, value in {
+            "DB_PATH": os.path.join(tmp_path, "w.db"),
+            "BOT_API_URL": f"http://127.0.0.1:{fake_api}",
+            "WEBHOOK_URL": f"http://127.0.0.1:{hook}/hook",
+            "WEBHOOK_LISTEN": "127.0.0.1",
+            "WEBHOOK_PORT": hook,
+            "WEBHOOK_SECRET": SECRET}.items():
+        monkeypatch.setattr(main, name, value)
+    update = {"update_id": 1, "message": {
+        "message_id": 1, "date": int(time.time()), "text": "привет",
+        "chat": loadtest._chat(CID), "from": loadtest._user(UID)}}
+
+    async def run():
+        main.init_db()
+        app = main.build_app("123456:WEBHOOK")
+        await app.initialize()
+        # то же, что делает run_webhook, но в нашем event loop
+        await app.updater.start_webhook(**main.webhook_args())
+        await app.start()
+        try:
+            loop = asyncio.get_running_loop()
+            url = main.WEBHOOK_URL
+            bad = await loop.run_in_executor(None, _post, url, "x", update)
+            ok = await loop.run_in_executor(None, _post, url, SECRET, update)
+            for _ in range(100):
+                if main.wb.cnt_delta(UID, CID):
+                    break
+                await asyncio.sleep(0.05)
+            return bad, ok, main.msg_cnt(UID, CID)
+        finally:
+            await app.updater.stop()
+            await app.stop()
+            await app.shutdown()
+            main.close_db()
+            main._db_pool.shutdown()
+
+    bad, ok, cnt = asyncio.run(run())
+    assert bad == 403
+    assert ok == 200
+    assert cnt == 1      # апдейт с верным секретом обработан, с чужим — нет
+    assert loadtest.stats(fake_api)["calls"].get("setWebhook") == 1